@@ -0,0 +1,300 @@
+"""Coalescing of identical concurrent requests.
+
+When several identical ``GET`` requests of the same user reach an
+adapter declaring ``coalesce`` at the same time, only the first one
+(the *leader*) is sent to the workers.  The other requests (the
+*followers*) register themselves in the flight of the leader, and
+stream its response.  The coordination happens in Redis, so it works
+across all the processes of the API server.
+
+A flight is a Redis list.  Once the leader sees it has followers, it
+appends the status and headers of its response, what it already
+produced, and then the rest of the body as it's produced (at most
+every ``POLL_INTERVAL`` seconds), and finally the end of the response.
+The followers read the list from the start, so they can join at any
+time.
+
+If the leader can't share its response (its client went away, it
+failed to execute, or the response is larger than
+``response_cache.MAX_SIZE``), the followers that didn't get anything
+yet execute the request themselves, while the ones already streaming
+it end their response with an error report in its format (see
+``formats.error_report``).
+
+"""
+
+import json
+import time
+import uuid
+
+from flask import Response
+import redis
+
+from .config import Config, get_option
+from . import formats, response_cache
+
+
+# Redis database for the requests in flight
+FLIGHT_DB = 12
+ENABLED = get_option('coalesce', 'enabled', True)
+# Seconds a finished flight is kept for the followers still reading it
+LINGER = 30
+# Seconds in between publications of the leader and reads of the followers
+POLL_INTERVAL = 0.05
+
+# Kinds of the entries of a flight: status and headers of the response,
+# part of the body, end of the body, and end of an incomplete body
+META, DATA, END, ABORT = 'm', 'd', 'e', 'a'
+
+_db = redis.StrictRedis(host=Config.get('store', 'host'),
+                        port=Config.getint('store', 'port'),
+                        db=FLIGHT_DB)
+
+
+def coalescable(service, req):
+    """Whether ``req`` can share the response of an identical request.
+
+    :type req: flask.Request
+    :rtype: bool
+    """
+    return (ENABLED and getattr(service, 'coalesce', False) and
+            req.method == 'GET' and service.type != 'passthrough')
+
+
+def run(service, endpoint, req, execute):
+    """Return the response of ``execute()``, sharing it if possible.
+
+    If an identical request is in flight, follow it instead of calling
+    ``execute``.
+
+    :type execute: () -> flask.Response
+    :rtype: flask.Response
+    """
+    if not coalescable(service, req):
+        return execute()
+    fmt = formats.negotiate(req)
+    # responses are never shared between users
+    key = 'flight:' + response_cache.cache_key(service, endpoint, req,
+                                               per_user=True)
+    timeout = (getattr(service, 'timeout', 30) or 30) + LINGER
+    flight = uuid.uuid4().hex
+    try:
+        # two attempts, in case the flight ends between SET and GET
+        for _ in range(2):
+            if _db.set(key, flight, nx=True, ex=timeout):
+                return _lead(Leader(key, flight, timeout), execute)
+            current = _db.get(key)
+            if current is not None:
+                response = _follow(key, current, timeout, fmt)
+                if response is not None:
+                    return response
+                break
+    except redis.RedisError:
+        pass
+    return execute()
+
+
+def _followers(flight):
+    return flight + ':followers'
+
+
+class Leader(object):
+    """Publish the response of the leader of ``flight`` as it's produced.
+
+    Nothing is written to the flight until it has followers: the body
+    is kept in memory meanwhile.
+
+    """
+
+    def __init__(self, key, flight, timeout):
+        self.key = key
+        self.flight = flight
+        self.timeout = timeout
+        self.meta = None
+        self.pending = []
+        self.size = 0
+        self.publishing = False
+        self.sharing = True
+        self._last_flush = time.time()
+
+    def start(self, status, headers):
+        self.meta = META + json.dumps({'status': status, 'headers': headers})
+
+    def add(self, chunk):
+        """Add ``chunk`` to the body, publishing it if it's time."""
+
+        if not self.sharing:
+            return
+        self.size += len(chunk)
+        if self.size > response_cache.MAX_SIZE:
+            # too large to share
+            self.finish(ABORT)
+            return
+        self.pending.append(chunk)
+        if time.time() - self._last_flush >= POLL_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Publish the pending part of the body, if there are followers."""
+
+        self._last_flush = time.time()
+        entries = []
+        if not self.publishing:
+            if not int(_db.get(_followers(self.flight)) or 0):
+                return
+            self.publishing = True
+            entries.append(self.meta)
+        if self.pending:
+            entries.append(DATA + ''.join(self.pending))
+            self.pending = []
+        if entries:
+            (_db.pipeline()
+                .rpush(self.flight, *entries)
+                .expire(self.flight, self.timeout)
+                .execute())
+
+    def finish(self, end):
+        """End the flight with ``end``, and release its key.
+
+        The key is released after publishing, so a follower that still
+        finds it has been counted, or will see that the flight is over
+        without a response (and then execute the request itself).
+
+        """
+        if not self.sharing:
+            return
+        self.sharing = False
+        try:
+            if end != ABORT and self.meta is not None:
+                self.flush()
+            if self.publishing:
+                (_db.pipeline()
+                    .rpush(self.flight, end)
+                    .expire(self.flight, LINGER)
+                    .execute())
+            # release the key only if it still belongs to this flight
+            if _db.get(self.key) == self.flight:
+                _db.delete(self.key)
+        except redis.RedisError:
+            pass
+
+
+def _lead(leader, execute):
+    """Execute the request, sharing the response with the followers."""
+
+    try:
+        response = execute()
+    except Exception:
+        leader.finish(ABORT)
+        raise
+    headers = [(header, value) for header, value in response.headers.items()
+               if header.lower() != 'content-length']
+    leader.start(response.status_code, headers)
+    chunks = response.response
+    response.response = formats.Stream(
+        lambda stream: _share(stream, leader, chunks))
+    return response
+
+
+def _share(stream, leader, chunks):
+    """Produce ``chunks``, and publish them through ``leader``.
+
+    A failure of ``chunks`` (including its error report) is passed on
+    to ``stream`` and to the followers.
+
+    """
+    end = ABORT
+    try:
+        for chunk in chunks:
+            yield chunk
+            try:
+                leader.add(chunk)
+            except redis.RedisError:
+                leader.finish(ABORT)
+        end = END
+    finally:
+        stream.failed = formats.failed(chunks)
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            # propagate a disconnection of the client to the producer
+            close()
+        if end == END and stream.failed:
+            end = END + 'failed'
+        leader.finish(end)
+
+
+def _follow(key, flight, timeout, fmt):
+    """Return a response streaming the results of ``flight``.
+
+    Return None if the leader ends without sharing its response (so the
+    request is executed instead), or it doesn't start it within
+    ``timeout`` seconds.
+
+    :rtype: flask.Response|None
+    """
+    (_db.pipeline()
+        .incr(_followers(flight))
+        .expire(_followers(flight), timeout)
+        .execute())
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        # read the key before the flight: the leader publishes before
+        # releasing the key, so a flight without entries once the key
+        # is released was not shared
+        current, entries = (_db.pipeline()
+                            .get(key)
+                            .lrange(flight, 0, -1)
+                            .execute())
+        if entries:
+            break
+        if current != flight:
+            return None
+        time.sleep(POLL_INTERVAL)
+    else:
+        return None
+    meta = json.loads(entries[0][len(META):])
+    response = Response(
+        formats.Stream(lambda stream: _stream(
+            stream, flight, entries[1:], deadline, fmt)),
+        status=meta['status'],
+        headers=[tuple(header) for header in meta['headers']],
+        direct_passthrough=True)
+    response.headers['X-Adama-Coalesced'] = 'yes'
+    # the leader already saves the response into the cache
+    response.cacheable = False
+    return response
+
+
+def _stream(stream, flight, entries, deadline, fmt):
+    """Produce the body published in ``flight``, starting with ``entries``.
+
+    The body ends with an error report in the format ``fmt`` if the
+    leader aborts, or it doesn't end before ``deadline``.
+
+    """
+    read = len(entries) + 1
+    while True:
+        for entry in entries:
+            kind, data = entry[0], entry[1:]
+            if kind == DATA:
+                yield data
+            elif kind == END:
+                stream.failed = bool(data)
+                return
+            else:
+                stream.failed = True
+                yield formats.error_report(
+                    fmt, 'coalesced request aborted by its leader\n')
+                return
+        if time.time() > deadline:
+            stream.failed = True
+            yield formats.error_report(
+                fmt, 'coalesced request timed out\n')
+            return
+        try:
+            entries = _db.lrange(flight, read, -1)
+        except redis.RedisError:
+            entries = [ABORT]
+        read += len(entries)
+        if not entries:
+            time.sleep(POLL_INTERVAL)
@@ -8,7 +8,7 @@ import tempfile
 from ..stores import entity_store
 from ..stores import service_store
 from ..stores import namespace_store
-from ..docker import safe_docker
+from ..docker import copy_from
 from ..entity import Entity
 
 def rebuild_service(name):
@@ -96,7 +96,7 @@ def _backup_code(srv, destination):
     try:
         worker = srv.workers[0]
         tempdir = tempfile.mkdtemp()
-        safe_docker('cp', '{}:/root/user_code'.format(worker), tempdir)
+        copy_from(worker, '/root/user_code', tempdir)
     except IndexError:
         return
     with tarfile.open(target, 'w:bz2') as tar:
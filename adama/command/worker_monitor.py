@@ -1,11 +1,82 @@
-import docker
+import json
+import time
+
+import docker.errors
 
 from ..config import Config
+from ..docker import exec_status, is_running
+from ..stores import worker_store
 from .tools import workers_of
-from ..tasks import QueueConnection
+from ..tasks import QueueConnection, HEARTBEAT_QUEUE
+
+
+# A worker without heartbeats for this long is considered down
+HEARTBEAT_TTL = 10  # seconds
+# Heartbeats are removed from the registry after this long
+HEARTBEAT_EXPIRY = HEARTBEAT_TTL + 5  # seconds
+# Workers are remembered as sending heartbeats for this long after the
+# last one
+SENDER_EXPIRY = 24 * 3600  # seconds
+
+
+def worker_state(cid):
+    """Last heartbeat of a worker, or None if the worker is down.
+
+    Workers report their hostname, which Docker sets to the first 12
+    characters of the container id.
+
+    Workers that never sent a heartbeat (the ones from images built
+    before heartbeats, and the JavaScript and Ruby workers) are checked
+    through Docker instead (see ``container_state``).
+
+    :type cid: str
+    :rtype: dict|None
+    """
+    beat = last_heartbeat(cid)
+    if beat is not None or sender_key(cid[:12]) in worker_store:
+        return beat
+    return container_state(cid)
+
+
+def last_heartbeat(cid):
+    """Last heartbeat of a worker, or None if it's not recent.
+
+    :type cid: str
+    :rtype: dict|None
+    """
+    try:
+        beat = worker_store[cid[:12]]
+    except KeyError:
+        return None
+    if time.time() - beat['received'] > HEARTBEAT_TTL:
+        return None
+    return beat
 
 
-DOCKER_CLIENT = docker.Client(version='auto')
+def container_state(cid):
+    """State of a worker without heartbeats, or None if it's down.
+
+    The worker is up while its container runs, and busy while the file
+    ``/busy`` exists in the container.
+
+    :type cid: str
+    :rtype: dict|None
+    """
+    if not is_running(cid):
+        return None
+    try:
+        busy = exec_status(cid, 'cat', '/busy') == 0
+    except docker.errors.APIError:
+        return None
+    return {
+        'worker': cid[:12],
+        'state': 'busy' if busy else 'idle',
+        'request': None
+    }
+
+
+def sender_key(worker):
+    return 'sender:{}'.format(worker)
 
 
 def is_up(cid):
@@ -14,11 +85,7 @@ def is_up(cid):
     :type cid: str
     :rtype: bool
     """
-    try:
-        info = DOCKER_CLIENT.inspect_container(cid)
-    except docker.errors.APIError:
-        return False
-    return info['State']['Running']
+    return worker_state(cid) is not None
 
 
 def is_ready(cid):
@@ -29,14 +96,8 @@ def is_ready(cid):
     :type cid: str
     :rtype: bool
     """
-    if not is_up(cid):
-        return False
-    cat = DOCKER_CLIENT.exec_create(
-        cid, ['cat', '/busy'], stdout=True, stderr=True)
-    DOCKER_CLIENT.exec_start(cat['Id'])
-    exit_code = DOCKER_CLIENT.exec_inspect(cat['Id'])['ExitCode']
-    # if there is no file /busy, the worker is ready
-    return exit_code != 0
+    state = worker_state(cid)
+    return state is not None and state['state'] == 'idle'
 
 
 def workers_ready_for(service_name):
@@ -69,4 +130,41 @@ def queue_size(service_name):
         Config.get('queue', 'host'),
         Config.getint('queue', 'port'),
         service_name)
-    return queue.size()
\ No newline at end of file
+    return queue.size()
+
+
+def record_heartbeat(beat):
+    """Save the heartbeat of a worker in the registry.
+
+    The heartbeat expires, so the registry doesn't keep the workers
+    that are gone.
+
+    :type beat: dict
+    :rtype: None
+    """
+    beat['received'] = time.time()
+    worker_store.setex(beat['worker'], HEARTBEAT_EXPIRY, beat)
+    worker_store.setex(sender_key(beat['worker']), SENDER_EXPIRY, True)
+
+
+class HeartbeatMonitor(QueueConnection):
+    """Keep ``worker_store`` up to date with the workers' heartbeats."""
+
+    def __init__(self):
+        super(HeartbeatMonitor, self).__init__(
+            Config.get('queue', 'host'),
+            Config.getint('queue', 'port'),
+            HEARTBEAT_QUEUE)
+
+    def run(self):
+        self.consume_forever(record_heartbeat)
+
+    def on_consume(self, callback, ch, method, props, body):
+        del props
+        try:
+            callback(json.loads(body))
+        except (ValueError, KeyError):
+            # ignore malformed heartbeats
+            pass
+        finally:
+            ch.basic_ack(delivery_tag=method.delivery_tag)
@@ -23,3 +23,17 @@ def read_config():
     return parser
 
 Config = read_config()
+
+
+def get_option(section, option, default):
+    """Return an option converted to the type of ``default``.
+
+    Return ``default`` if the option is not in the config files.
+
+    """
+    try:
+        if isinstance(default, bool):
+            return Config.getboolean(section, option)
+        return type(default)(Config.get(section, option))
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
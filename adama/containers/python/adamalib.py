@@ -1,6 +1,12 @@
+import collections
+import cPickle
+import functools
+import hashlib
 import sys
 import json
+import time
 
+import redis
 import requests
 from tasks import Producer
 from store import Store
@@ -12,18 +18,26 @@ sys.modules['adama.firewall'] = service
 
 REGISTER_TIMEOUT = 30  # seconds
 
+# Redis database shared by the caches of all the workers
+CACHE_DB = 9
+# Maximum number of entries in the in-process cache of a worker
+CACHE_SIZE = 1024
+# Default time to live of cached values
+CACHE_TTL = 3600  # seconds
+
 
 class Adama(object):
 
     def __init__(self, token, url=None,
                  queue_host=None, queue_port=None,
                  store_host=None, store_port=None,
-                 headers=None, responder=None):
+                 headers=None, responder=None, service=None):
         """
         :type token: str
         :type url: str
         :type queue_host: str
         :type queue_port: int
+        :type service: str
         :rtype: None
         """
         self.token = token
@@ -34,13 +48,28 @@ class Adama(object):
         self.store_port = store_port
         self.headers = headers
         self.responder = responder
+        self.service = service
         self._prov = None
         self._time = None
+        self._cache = None
+        # time spent in upstream requests made through adamalib
+        self._http_time = 0.0
 
     @property
     def utils(self):
         return Utils(self)
 
+    @property
+    def cache(self):
+        """Cache shared by all the requests to this service.
+
+        :rtype: Cache
+        """
+        if self._cache is None:
+            self._cache = Cache(self.service, self.store_host,
+                                self.store_port)
+        return self._cache
+
     def error(self, message, obj=None):
         """
         :type message: str
@@ -98,6 +127,175 @@ class Adama(object):
         return Namespace(self, item)
 
 
+class LRU(object):
+    """In-process cache of at most ``size`` entries with expiration."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Return the value for ``key`` or raise ``KeyError``."""
+
+        expires, value = self._entries.pop(key)
+        if expires is not None and expires < time.time():
+            raise KeyError(key)
+        # re-insert to mark it as the most recently used
+        self._entries[key] = (expires, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._entries.pop(key, None)
+        self._entries[key] = (
+            time.time() + ttl if ttl else None, value)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+# The in-process cache outlives the requests served by a worker
+LOCAL_CACHE = LRU()
+
+
+class Cache(object):
+    """Two level cache for adapter functions.
+
+    Values are looked up first in the in-process ``LOCAL_CACHE`` of the
+    worker and then in the Redis store shared by all the workers.  Keys
+    are namespaced by service, so adapters never see each other's
+    entries.
+
+    Values must be JSON serializable.  Both levels keep them as JSON
+    (the store is reachable by the workers of all the services, so it
+    never holds pickles), and every lookup returns a new copy.  The
+    entries of a service are removed when it's updated.
+
+    Use as::
+
+        value = adama.cache.get('AT1G01010')
+        adama.cache.set('AT1G01010', value, ttl=600)
+
+        @adama.cache.memoize(ttl=600)
+        def fetch(locus):
+            ...
+
+    """
+
+    def __init__(self, service, store_host=None, store_port=None,
+                 local=LOCAL_CACHE):
+        """
+        :type service: str
+        :type store_host: str
+        :type store_port: int
+        :type local: LRU
+        :rtype: None
+        """
+        self.service = service
+        self.local = local
+        self.hits = 0
+        self.misses = 0
+        self._db = (redis.StrictRedis(host=store_host, port=store_port,
+                                      db=CACHE_DB)
+                    if store_host else None)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _key(self, key):
+        return 'cache:{}:{}'.format(self.service, key)
+
+    def _lookup(self, key):
+        """Return the value for ``key`` or raise ``KeyError``."""
+
+        full_key = self._key(key)
+        try:
+            obj = self.local.get(full_key)
+        except KeyError:
+            obj = self._fetch(full_key)
+        if obj is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return json.loads(obj)
+
+    def _fetch(self, full_key):
+        """Return the JSON for ``full_key`` from the store, or None."""
+
+        if self._db is None:
+            return None
+        try:
+            obj, ttl = self._db.pipeline().get(full_key).ttl(
+                full_key).execute()
+        except redis.RedisError:
+            # the cache is an optimization: ignore the store if it's
+            # not reachable
+            return None
+        if obj is not None:
+            self.local.set(full_key, obj, ttl if ttl and ttl > 0 else None)
+        return obj
+
+    def get(self, key, default=None):
+        """
+        :type key: str
+        :type default: object
+        :rtype: object
+        """
+        try:
+            return self._lookup(key)
+        except KeyError:
+            return default
+
+    def set(self, key, value, ttl=CACHE_TTL):
+        """
+        :type key: str
+        :type value: object
+        :type ttl: int
+        :rtype: None
+        """
+        full_key = self._key(key)
+        obj = json.dumps(value)
+        self.local.set(full_key, obj, ttl)
+        if self._db is not None:
+            try:
+                if ttl:
+                    self._db.setex(full_key, ttl, obj)
+                else:
+                    self._db.set(full_key, obj)
+            except redis.RedisError:
+                pass
+
+    def memoize(self, ttl=CACHE_TTL, key=None):
+        """Decorator caching the results of a function.
+
+        ``key`` is a function taking the same arguments as the decorated
+        function and returning the key for the cache.  By default, the
+        key is a hash of the name of the function and its arguments.
+        The results of the function must be JSON serializable.
+
+        """
+        def decorator(fun):
+            @functools.wraps(fun)
+            def wrapper(*args, **kwargs):
+                if key is not None:
+                    k = key(*args, **kwargs)
+                else:
+                    k = '{}.{}:{}'.format(
+                        fun.__module__, fun.__name__,
+                        hashlib.sha1(cPickle.dumps(
+                            (args, sorted(kwargs.items())))).hexdigest())
+                try:
+                    return self._lookup(k)
+                except KeyError:
+                    value = fun(*args, **kwargs)
+                    self.set(k, value, ttl)
+                    return value
+            return wrapper
+        return decorator
+
+
 class APIException(Exception):
 
     def __init__(self, msg, obj=None):
@@ -278,7 +476,11 @@ class Utils(object):
         :type kwargs: dict[str, object]
         :rtype: requests.Response
         """
-        resp = requests.get(url, params=kwargs)
+        start = time.time()
+        try:
+            resp = requests.get(url, params=kwargs)
+        finally:
+            self.adama._http_time += time.time() - start
         if not resp.ok:
             self.adama.error(resp.text, resp)
         return resp
\ No newline at end of file
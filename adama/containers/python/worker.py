@@ -2,48 +2,262 @@
 from __future__ import print_function
 
 import argparse
-import base64
 import json
 import importlib
 import logging
 import os
+import resource
+import signal
 import sys
+import threading
 import time
 import traceback
 import inspect
 
-from tasks import QueueConnection
-from adamalib import Adama
+import redis
+
+from tasks import QueueConnection, HEARTBEAT_QUEUE, CANCEL_DB, cancel_key
+from adamalib import Adama, LOCAL_CACHE
 
 logging.basicConfig()
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
+# Seconds between heartbeats of a worker
+HEARTBEAT_INTERVAL = 2
+# Version of the messages understood by this worker, reported in the
+# heartbeats (2: map_filter takes batches of records)
+PROTOCOL = 2
+# Check for a cancellation every these many seconds or records
+CANCEL_CHECK_INTERVAL = 0.5
+CANCEL_CHECK_RECORDS = 100
+# Seconds between checks for a pending reload while idle
+RELOAD_CHECK_INTERVAL = 0.5
+
+
+class Heartbeat(threading.Thread):
+    """Publish the state of the worker to the heartbeats queue.
+
+    A heartbeat is sent every ``HEARTBEAT_INTERVAL`` seconds, and right
+    away when the worker starts or finishes a request.
+
+    """
+
+    def __init__(self, queue_host, queue_port, queue_name):
+        super(Heartbeat, self).__init__(name='heartbeat')
+        self.daemon = True
+        self.queue_host = queue_host
+        self.queue_port = queue_port
+        self.queue_name = queue_name
+        self.state = 'idle'
+        self.request = None
+        self.served = 0
+        self._changed = threading.Event()
+
+    def busy(self, request):
+        self.state = 'busy'
+        self.request = request
+        self._changed.set()
+
+    def idle(self):
+        self.state = 'idle'
+        self.request = None
+        self.served += 1
+        self._changed.set()
+
+    def to_json(self):
+        return {
+            'worker': os.uname()[1],
+            'queue': self.queue_name,
+            'state': self.state,
+            'request': self.request,
+            'served': self.served,
+            'protocol': PROTOCOL,
+            'rss': rss(),
+            'timestamp': time.time()
+        }
+
+    def run(self):
+        control = None
+        while True:
+            try:
+                if control is None:
+                    control = QueueConnection(
+                        self.queue_host, self.queue_port, HEARTBEAT_QUEUE)
+                control.publish(json.dumps(self.to_json()),
+                                ttl=5 * HEARTBEAT_INTERVAL)
+            except Exception:
+                # try to reconnect in the next beat
+                control = None
+            self._changed.wait(HEARTBEAT_INTERVAL)
+            self._changed.clear()
+
+
+def rss():
+    """Current resident set size of this process, in bytes."""
+
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+class Drained(BaseException):
+    """Raised to stop consuming once a drain was requested.
 
-def touch(fname):
-    """Create a file `fname` with the local timestamp as content.
+    It's not an ``Exception`` so ``consume_forever`` doesn't try to
+    reconnect.
 
-    *Warning*: this is executed in a container, so make sure the timezone
-    correspond to the one of the host.
+    """
+
+
+class Cancelled(BaseException):
+    """Raised in the adapter code when the producer needs no more results.
+
+    It's not an ``Exception`` so the code of the adapter doesn't catch it
+    by accident.
 
-    :type fname: str
-    :rtype: None
     """
-    with open(fname, 'a') as f:
-        f.write(str(time.time()))
 
 
-class QueryWorker(QueueConnection):
+class Cancellation(object):
+    """Decide when to stop producing results for a request.
+
+    A request is cancelled when ``limit`` records were produced, or when
+    the producer flags it in the store (see ``Producer.cancel``), for
+    example because the client disconnected.
+
+    """
+
+    def __init__(self, message_id, store_host=None, store_port=None,
+                 limit=None):
+        self.key = cancel_key(message_id)
+        self.limit = limit
+        self.db = (redis.StrictRedis(host=store_host, port=store_port,
+                                     db=CANCEL_DB)
+                   if message_id and store_host else None)
+        self._last_check = time.time()
+
+    def is_set(self, records):
+        """Whether to stop, after producing ``records`` records."""
+
+        if self.limit is not None and records >= self.limit:
+            return True
+        if self.db is None:
+            return False
+        now = time.time()
+        if (now - self._last_check < CANCEL_CHECK_INTERVAL and
+                records % CANCEL_CHECK_RECORDS):
+            return False
+        self._last_check = now
+        try:
+            return bool(self.db.exists(self.key))
+        except redis.RedisError:
+            return False
+
+
+class Worker(QueueConnection):
+    """Consume requests from the queue while sending heartbeats.
+
+    On SIGTERM the worker finishes the request in progress, if any, and
+    exits.  On SIGHUP the user code is reloaded from the user code
+    directory, in between requests: the signal handler only flags the
+    reload, so it never runs in the middle of the queue connection.
+
+    """
+
+    def connect(self):
+        super(Worker, self).connect()
+        # reconnections get a new timer
+        self.connection.add_timeout(RELOAD_CHECK_INTERVAL, self.check_reload)
+
+    def run(self):
+        self.module = find_main_module()
+        self.busy = False
+        self.draining = False
+        self.reloading = False
+        signal.signal(signal.SIGTERM, self.on_drain)
+        signal.signal(signal.SIGHUP, self.on_reload)
+        self.heartbeat = Heartbeat(
+            self.queue_host, self.queue_port, self.queue_name)
+        self.heartbeat.start()
+        self.consume_forever(self.callback)
+
+    def on_drain(self, signum, frame):
+        self.draining = True
+        if not self.busy:
+            raise Drained()
+
+    def on_reload(self, signum, frame):
+        self.reloading = True
+
+    def check_reload(self):
+        """Reload if flagged while waiting for requests."""
+
+        if getattr(self, 'reloading', False) and not self.busy:
+            self.reload()
+        self.connection.add_timeout(RELOAD_CHECK_INTERVAL, self.check_reload)
+
+    def reload(self):
+        """Reload the main module and the modules it uses from user code.
+
+        All the modules loaded from the user code directory are
+        forgotten, so importing the main module again imports the new
+        versions of its helper modules too.
+
+        If the new code fails to import, the worker keeps serving with
+        the old one and reports the error (the service is rebuilt then).
+
+        """
+        self.reloading = False
+        user_code = os.path.join(HERE, 'user_code') + os.sep
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, '__file__', None)
+            if path is None or not os.path.abspath(path).startswith(user_code):
+                continue
+            source, ext = os.path.splitext(path)
+            # force recompiling if the source was updated in the same second
+            if (ext == '.pyc' and os.path.exists(source + '.py') and
+                    os.path.exists(path)):
+                os.unlink(path)
+            del sys.modules[name]
+        try:
+            self.module = importlib.import_module(self.module.__name__)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            print('*** WORKER ERROR', file=sys.stderr)
+            return
+        # values cached by the old code
+        LOCAL_CACHE.clear()
+        print('*** WORKER RELOADED', file=sys.stderr)
+
+    def on_consume(self, callback, ch, method, props, body):
+        self.busy = True
+        self.message_id = props.message_id
+        self.heartbeat.busy(props.message_id)
+        try:
+            super(Worker, self).on_consume(callback, ch, method, props, body)
+        finally:
+            self.busy = False
+            self.heartbeat.idle()
+        if self.draining:
+            raise Drained()
+        if self.reloading:
+            self.reload()
+
+
+class QueryWorker(Worker):
 
     def callback(self, message, responder):
         _time = None
         _prov = None
+        self.adama = None
+        responder = Telemetry(responder, self.queue_wait)
         with Results(responder):
             try:
-                touch('/busy')
                 adama = self.operation(message, responder=responder)
                 _time = adama._time
                 _prov = adama._prov
+            except Cancelled:
+                pass
             except Exception as exc:
                 print('ERROR')
                 print(json.dumps({
@@ -51,22 +265,33 @@ class QueryWorker(QueueConnection):
                     'traceback': traceback.format_exc()
                 }))
             finally:
-                os.unlink('/busy')
+                # the adapter is done: a cancellation now just drops the
+                # pending results
+                responder.finishing = True
                 print('END')
-                responder(json.dumps({'time_in_main': _time,
-                                      'prov': _prov}))
+                responder(json.dumps({
+                    'time_in_main': _time,
+                    'prov': _prov,
+                    'cache': cache_stats(self.adama),
+                    'telemetry': responder.to_json(self.adama)}))
 
     def operation(self, body, responder=None):
         d = json.loads(body)
         d['_worker'] = os.uname()[1]
         endpoint = d['_endpoint']
         t_start = time.time()
+        # '_limit' is the number of records the producer will consume
+        responder.cancellation = Cancellation(
+            self.message_id, d.get('_store_host'), d.get('_store_port'),
+            d.get('_limit'))
 
         adama = Adama(d.get('_token'), d.get('_url'),
                       d.get('_queue_host'), d.get('_queue_port'),
                       d.get('_store_host'), d.get('_store_port'),
                       d.get('_headers'),
-                      responder=responder)
+                      responder=responder,
+                      service=self.queue_name)
+        self.adama = adama
         fun = getattr(self.module, endpoint)
         if len(inspect.getargspec(fun).args) == 1:
             # old style function: don't use Adama object
@@ -78,27 +303,24 @@ class QueryWorker(QueueConnection):
         adama._time = t_end - t_start
         return adama
 
-    def run(self):
-        self.module = find_main_module()
-        self.consume_forever(self.callback)
-
-
-class GenericWorker(QueueConnection):
 
-    def run(self):
-        self.module = find_main_module()
-        self.consume_forever(self.callback)
+class GenericWorker(Worker):
 
     def operation(self, body, responder):
         d = json.loads(body)
         d['_worker'] = os.uname()[1]
         endpoint = d['_endpoint']
 
+        responder.cancellation = Cancellation(
+            self.message_id, d.get('_store_host'), d.get('_store_port'))
+
         adama = Adama(d.get('_token'), d.get('_url'),
                       d.get('_queue_host'), d.get('_queue_port'),
                       d.get('_store_host'), d.get('_store_port'),
                       d.get('_headers'),
-                      responder=responder)
+                      responder=responder,
+                      service=self.queue_name)
+        self.adama = adama
 
         fun = getattr(self.module, endpoint)
         if len(inspect.getargspec(fun).args) == 1:
@@ -108,56 +330,165 @@ class GenericWorker(QueueConnection):
             return fun(d, adama)
 
     def callback(self, message, responder):
+        """Send the body returned by the adapter as binary chunks.
+
+        The adapter returns the content type and either the whole body
+        or an iterator of chunks of it.
+
+        """
+        self.adama = None
+        responder = Telemetry(responder, self.queue_wait)
         try:
-            touch('/busy')
             content_type, body = self.operation(message, responder)
-            responder(json.dumps({
-                'content_type': content_type,
-                'body': base64.b64encode(body)
-            }))
+            responder('HEADER')
+            responder(json.dumps({'content_type': content_type}))
+            if isinstance(body, basestring):
+                body = [body]
+            for chunk in body:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                responder.chunk(chunk)
+        except Cancelled:
+            pass
         except Exception as exc:
-            responder(json.dumps({
+            responder.error(json.dumps({
                 'error': str(exc.message),
                 'traceback': traceback.format_exc()
             }))
         finally:
-            os.unlink('/busy')
             responder('END')
-            responder(json.dumps({}))
+            responder(json.dumps({
+                'cache': cache_stats(self.adama),
+                'telemetry': responder.to_json(self.adama)}))
 
 
-class ProcessWorker(QueueConnection):
-
-    def run(self):
-        self.module = find_main_module()
-        self.consume_forever(self.callback)
+class ProcessWorker(Worker):
 
     def callback(self, message, responder):
+        seq = None
+        adama = None
+        responder = Telemetry(responder, self.queue_wait)
         try:
-            touch('/busy')
             d = json.loads(message)
+            # a batch carries the records in '_batch' and the common
+            # fields (token, headers, etc.) at the top level
+            batch = d.pop('_batch', None)
+            seq = d.pop('_seq', None)
+            records = [d] if batch is None else [dict(record, **d)
+                                                 for record in batch]
+            responder.cancellation = Cancellation(
+                self.message_id, d.get('_store_host'), d.get('_store_port'))
             adama = Adama(d.get('_token'), d.get('_url'),
                           d.get('_queue_host'), d.get('_queue_port'),
                           d.get('_store_host'), d.get('_store_port'),
                           d.get('_headers'),
-                          responder=responder)
+                          responder=responder,
+                          service=self.queue_name)
             fun = self.module.map_filter
-            if len(inspect.getargspec(fun).args) == 1:
-                # old style function: don't use Adama object
-                out = fun(d)
-            else:
-                out = fun(d, adama)
-            if out is not None:
-                responder(json.dumps(out))
+            # old style function: don't use Adama object
+            old_style = len(inspect.getargspec(fun).args) == 1
+            for record in records:
+                out = fun(record) if old_style else fun(record, adama)
+                if out is not None:
+                    responder(json.dumps(out))
+        except Cancelled:
+            pass
         except Exception as exc:
-            responder(json.dumps({
+            responder.error(json.dumps({
                 'error': str(exc.message),
                 'traceback': traceback.format_exc()
             }))
         finally:
-            os.unlink('/busy')
             responder('END')
-            responder(json.dumps({}))
+            responder(json.dumps({
+                'seq': seq,
+                'cache': cache_stats(adama),
+                'telemetry': responder.to_json(adama)}))
+
+
+def cache_stats(adama):
+    """Hit/miss counters of the cache used in a request, if any."""
+
+    if adama is None or adama._cache is None:
+        return None
+    return adama._cache.stats
+
+
+class Telemetry(object):
+    """Resources used by the worker to answer a request.
+
+    Wrap a ``responder`` to count the records and bytes sent back to the
+    producer.  Control messages (``HEADER``, ``END``) and the object
+    following each of them are not records.
+
+    If a ``cancellation`` is set, ``Cancelled`` is raised when it's time
+    to stop, and the records produced after that are dropped.  Once
+    ``finishing`` (the adapter returned), the records are dropped
+    without raising ``Cancelled``.
+
+    """
+
+    CONTROL = ('HEADER', 'END')
+
+    def __init__(self, responder, queue_wait=None):
+        self.responder = responder
+        self.queue_wait = queue_wait
+        self.records = 0
+        self.bytes = 0
+        self._skip_next = False
+        self._start = resource.getrusage(resource.RUSAGE_SELF)
+        self.cancellation = None
+        self.cancelled = False
+        self.finishing = False
+
+    def __call__(self, message):
+        if message in self.CONTROL:
+            self._skip_next = True
+        elif self._skip_next:
+            self._skip_next = False
+        else:
+            if not self._count(message):
+                return
+        self.responder(message)
+
+    def error(self, message):
+        """Send the error ``message``, which is not a record."""
+
+        self.responder(message)
+
+    def chunk(self, data):
+        """Send ``data`` as a binary chunk."""
+
+        if self._count(data):
+            self.responder.chunk(data)
+
+    def _count(self, record):
+        """Count ``record``, or return False if it must be dropped."""
+
+        if self.cancelled:
+            return False
+        if (self.cancellation is not None and
+                self.cancellation.is_set(self.records)):
+            self.cancelled = True
+            if self.finishing:
+                return False
+            raise Cancelled()
+        self.records += 1
+        self.bytes += len(record)
+        return True
+
+    def to_json(self, adama=None):
+        end = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            'queue_wait': self.queue_wait,
+            'cpu_user': end.ru_utime - self._start.ru_utime,
+            'cpu_sys': end.ru_stime - self._start.ru_stime,
+            # ru_maxrss is in kilobytes
+            'rss_delta': (end.ru_maxrss - self._start.ru_maxrss) * 1024,
+            'bytes': self.bytes,
+            'records': self.records,
+            'http_time': adama._http_time if adama is not None else None
+        }
 
 
 class Results(object):
@@ -240,12 +571,17 @@ def run_worker(worker_type, args):
     print('Listening in queue {}'.format(args.queue_name),
           file=sys.stderr)
     print('*** WORKER STARTED', file=sys.stderr)
+    drained = False
     try:
         worker.run()
+    except Drained:
+        drained = True
+        print('*** WORKER DRAINED', file=sys.stderr)
     finally:
-        traceback.print_exc(file=sys.stderr)
-        # If worker stops consuming, it's because of an error
-        print('*** WORKER ERROR', file=sys.stderr)
+        if not drained:
+            traceback.print_exc(file=sys.stderr)
+            # If worker stops consuming, it's because of an error
+            print('*** WORKER ERROR', file=sys.stderr)
 
 
 def wait_for_ready():
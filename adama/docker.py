@@ -1,12 +1,27 @@
-from __future__ import print_function
+"""Access to the Docker daemon.
 
+All the operations go through a single Engine API client per process
+(``client()``), which keeps its connections to the daemon open, instead
+of spawning the ``docker`` command for each call.
+
+"""
+
+from __future__ import absolute_import, print_function
+
+import io
+import json
 import os
-import random
+import socket
 import subprocess
 import sys
+import tarfile
+import threading
+
+import docker
+import docker.errors
 
 from .api import APIException
-from .config import Config
+from .config import Config, get_option
 from .tools import TimeoutFunction, TimeoutFunctionException
 
 
@@ -15,8 +30,45 @@ VETH_LENGTH = 14
 # max number of attempts to try to find a free ip
 MAX_ATTEMPTS = 10
 
+# Version of the Engine API ('auto' asks the daemon)
+API_VERSION = get_option('docker', 'api_version', 'auto')
+# Timeout for the calls to the daemon (except streams and builds)
+API_TIMEOUT = get_option('docker', 'api_timeout', 60)
+
+# Client for the current process: (pid, docker.Client)
+_client = (None, None)
+_client_lock = threading.Lock()
+
+
+def client():
+    """Return the Engine API client of this process.
+
+    The client is shared by the threads of a process.  A forked process
+    (for example, a ``multiprocessing.Process``) gets its own client, so
+    it never reuses the connections of its parent.
+
+    :rtype: docker.Client
+    """
+    global _client
+    pid, cli = _client
+    if pid == os.getpid():
+        return cli
+    with _client_lock:
+        pid, cli = _client
+        if pid != os.getpid():
+            cli = docker.Client(base_url=Config.get('docker', 'host') or None,
+                                version=API_VERSION,
+                                timeout=API_TIMEOUT)
+            _client = (os.getpid(), cli)
+        return cli
+
 
-def docker(*args, **kwargs):
+def docker_cli(*args, **kwargs):
+    """Spawn the ``docker`` command.
+
+    Only for operations not available in the Engine API client.
+
+    """
     host = Config.get('docker', 'host')
     cmd = [Config.get('docker', 'command')] + (['-H', host] if host else [])
     stderr = kwargs.get('stderr', subprocess.STDOUT)
@@ -29,35 +81,106 @@ def docker(*args, **kwargs):
 def safe_docker(*args):
     """Execute docker and raise exception with stderr&stdout if failed."""
 
-    proc = docker(*args, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+    proc = docker_cli(*args, stderr=subprocess.STDOUT,
+                      stdout=subprocess.PIPE)
     out, _ = proc.communicate()
     if proc.returncode:
         raise APIException(out)
 
 
 def docker_output(*args):
-    p = docker(*args, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+    p = docker_cli(*args, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
     return p.communicate()[0]
 
 
-def tail(fd, timeout=0, process=None):
-    f = os.fdopen(fd, 'r', 0)
-    readline = TimeoutFunction(f.readline, timeout)
+def tail(lines, timeout=0, close=None):
+    """Yield ``lines`` until none arrives in ``timeout`` seconds."""
+
+    get_next = TimeoutFunction(lambda: next(lines), timeout)
     try:
         while True:
-            yield readline()
-    except TimeoutFunctionException:
+            yield get_next()
+    except (TimeoutFunctionException, StopIteration):
         return
     finally:
-        f.close()
-        if process is not None:
-            process.kill()
+        if close is not None:
+            close()
 
 
 def tail_logs(container, timeout=0):
-    r, w = os.pipe()
-    logs = docker('logs', '-f', container, stderr=subprocess.STDOUT, stdout=w)
-    return tail(r, timeout, process=logs)
+    """Follow the logs of ``container``, line by line.
+
+    Stop when no output arrives for ``timeout`` seconds.
+
+    """
+    logs = client().logs(container, stdout=True, stderr=True, stream=True)
+    return tail(_lines(logs), timeout, close=getattr(logs, 'close', None))
+
+
+class Logs(object):
+    """The lines logged by ``container``, followed as they are written.
+
+    With ``since_now``, only the lines written after opening the stream
+    are produced.  ``close()`` ends the stream, from any thread.
+
+    """
+
+    def __init__(self, container, since_now=False):
+        cli = client()
+        # ``docker.Client.logs`` can't ask for no past lines (tail=0)
+        # nor give access to the connection
+        self._response = cli._get(
+            cli._url('/containers/{0}/logs'.format(container)),
+            params={'stdout': 1, 'stderr': 1, 'follow': 1,
+                    'tail': 0 if since_now else 'all'},
+            stream=True)
+        self._socket = cli._get_raw_response_socket(self._response)
+        self._lines = _lines(
+            cli._multiplexed_response_stream_helper(self._response))
+
+    def __iter__(self):
+        return self._lines
+
+    def close(self):
+        try:
+            # wake up a thread blocked reading the stream
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._response.close()
+
+
+def _lines(chunks):
+    """Split the chunks of a stream into lines."""
+
+    pending = ''
+    for chunk in chunks:
+        pending += chunk
+        while '\n' in pending:
+            line, pending = pending.split('\n', 1)
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def logs(container):
+    """Return the output of ``container`` so far."""
+
+    try:
+        return client().logs(container, stdout=True, stderr=True)
+    except docker.errors.APIError as exc:
+        return str(exc)
+
+
+def events(**filters):
+    """Stream the events of the daemon, as dictionaries.
+
+    ``filters`` are as in the Engine API (for example:
+    ``container=cid`` or ``event='die'``).
+
+    """
+    for event in client().events(filters=filters or None):
+        yield json.loads(event) if isinstance(event, basestring) else event
 
 
 def check_docker(display=False):
@@ -67,20 +190,138 @@ def check_docker(display=False):
 
     """
     try:
-        docker_output('ps')
+        client().version()
         return True
     except Exception:
         if display:
             print('No docker daemon listening at {0}'.
                   format(Config.get('docker', 'host')), file=sys.stderr)
-            print('or wrong command "{0}"'.
-                  format(Config.get('docker', 'command')), file=sys.stderr)
             print('Please, check ~/.adama.conf', file=sys.stderr)
         return False
 
 
+def build_image(path, tag):
+    """Build the image ``tag`` from the Dockerfile in ``path``.
+
+    Raise ``APIException`` with the output of the build if it fails.
+
+    """
+    output = []
+    for line in client().build(path=path, tag=tag, rm=True, stream=True):
+        try:
+            status = json.loads(line)
+        except ValueError:
+            output.append(line)
+            continue
+        output.append(status.get('stream', '') or
+                      status.get('status', ''))
+        if 'error' in status:
+            output.append(status['error'])
+            raise APIException(''.join(output))
+
+
+def image_exists(image):
+    """True if the daemon has the image ``image`` (``name[:tag]``)."""
+
+    try:
+        client().inspect_image(image)
+        return True
+    except docker.errors.APIError:
+        return False
+
+
+def image_id(image):
+    """Id of the image ``image``, or None if the daemon doesn't have it."""
+
+    try:
+        return client().inspect_image(image)['Id']
+    except docker.errors.APIError:
+        return None
+
+
+def tag_image(image, repository, tag):
+    """Tag ``image`` as ``repository:tag``, replacing a previous one."""
+
+    client().tag(image, repository, tag=tag, force=True)
+
+
 def start_container(iden, *params):
     """Run container from image ``iden``."""
 
-    container = docker_output('run', '-d', iden, *params).strip()
-    return container
+    container = client().create_container(image=iden, command=list(params))
+    client().start(container['Id'])
+    return container['Id']
+
+
+def exec_in(container, *cmd):
+    """Run ``cmd`` inside ``container`` and return its output."""
+
+    exc = client().exec_create(container, list(cmd),
+                               stdout=True, stderr=True)
+    return client().exec_start(exc['Id'])
+
+
+def exec_status(container, *cmd):
+    """Run ``cmd`` inside ``container`` and return its exit code."""
+
+    exc = client().exec_create(container, list(cmd),
+                               stdout=True, stderr=True)
+    client().exec_start(exc['Id'])
+    return client().exec_inspect(exc['Id'])['ExitCode']
+
+
+def is_running(container):
+    """Whether ``container`` exists and is running."""
+
+    try:
+        return client().inspect_container(container)['State']['Running']
+    except docker.errors.APIError:
+        return False
+
+
+def stop_container(container, timeout):
+    """Stop ``container``, killing it after ``timeout`` seconds."""
+
+    try:
+        client().stop(container, timeout=timeout)
+    except docker.errors.APIError:
+        pass
+
+
+def remove_container(container):
+    """Remove ``container``, killing it if it's running."""
+
+    try:
+        client().remove_container(container, force=True)
+    except docker.errors.APIError:
+        pass
+
+
+def kill_container(container, signal):
+    client().kill(container, signal=signal)
+
+
+def container_pid(container):
+    """Pid of the main process of ``container`` in the host."""
+
+    return str(client().inspect_container(container)['State']['Pid'])
+
+
+def copy_from(container, path, destination):
+    """Copy ``path`` in ``container`` into the directory ``destination``."""
+
+    archive = client().copy(container, path)
+    data = io.BytesIO(archive.read())
+    with tarfile.open(fileobj=data) as tar:
+        tar.extractall(destination)
+
+
+def copy_into(container, source, path):
+    """Copy the contents of the directory ``source`` to ``path``.
+
+    The API client doesn't support uploading archives, so this uses
+    the command line.
+
+    """
+    safe_docker('cp', os.path.join(source, '.'),
+                '{}:{}'.format(container, path))
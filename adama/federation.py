@@ -0,0 +1,250 @@
+"""Federated queries over several adapters.
+
+A federated query sends the same arguments to several ``query`` or
+``map_filter`` adapters at once, and merges their results in a single
+stream of newline delimited JSON, as they arrive.  The latency of a
+federated query is the latency of its slowest adapter, rather than the
+sum of the latencies.
+
+"""
+
+import json
+import numbers
+import Queue
+import textwrap
+import threading
+import time
+
+from flask import request, Response, stream_with_context
+from flask.ext import restful
+
+from .api import APIException
+from .service import get_service, store_prov
+from .stats import tick
+from .swagger import swagger
+from . import formats
+
+
+# Maximum number of adapters in a federated query
+MAX_TARGETS = 20
+# Results of each adapter kept in memory, waiting for the client
+RESULTS_PER_TARGET = 100
+# Seconds in between checks of the end of a query, while the queue is full
+POLL_INTERVAL = 0.5
+
+# Endpoints that can be federated, for each type of adapter
+ENDPOINTS = {
+    'query': ('search', 'list'),
+    'map_filter': ('search',)
+}
+
+# Kinds of messages from the threads querying the adapters
+RESULT, END = 'result', 'end'
+
+
+class FederationResource(restful.Resource):
+
+    @swagger.operation(
+        notes=textwrap.dedent(
+            """Perform a query on several adapters at once.
+
+            <p>The body is a JSON object with the fields
+            <code>targets</code>, a list of services (as
+            <code>namespace/service</code>, or as an object with the
+            fields <code>service</code> and <code>timeout</code>),
+            <code>args</code>, the parameters for all the services, and
+            optionally <code>endpoint</code>, <code>search</code> (by
+            default) or <code>list</code> (only for query
+            adapters).</p>
+
+            <p>The results are returned as newline delimited JSON, as
+            they arrive.  Each line has the field <code>source</code>
+            (the service) and either <code>result</code> (a result of
+            the service) or <code>status</code> (the end of the results
+            of the service: <code>success</code>, <code>error</code> or
+            <code>timeout</code>).  A service failing or timing out
+            keeps the results it already produced.</p>
+
+            """),
+        nickname='federate'
+    )
+    def post(self):
+        """Perform a query on several services"""
+
+        endpoint, args, targets = self.validate_post()
+        for target in targets:
+            tick(target['service'], request,
+                 endpoint='federate', args=args)
+        response = Response(
+            stream_with_context(federate(targets, endpoint, args,
+                                         request._get_current_object())),
+            mimetype='application/x-ndjson')
+        # the sources of all the services
+        response.headers['Link'] = ', '.join(
+            target['service'].prov_link(target['prov'])
+            for target in targets)
+        return response
+
+    def validate_post(self):
+        body = request.get_json(force=True, silent=True)
+        if not isinstance(body, dict):
+            raise APIException('body must be a JSON object', 400)
+        endpoint = body.get('endpoint', 'search')
+        if endpoint not in ENDPOINTS['query']:
+            raise APIException('endpoint must be one of: {}'
+                               .format(', '.join(ENDPOINTS['query'])), 400)
+        args = body.get('args', {})
+        if not isinstance(args, dict):
+            raise APIException('args must be a JSON object', 400)
+        targets = body.get('targets')
+        if not isinstance(targets, list) or not targets:
+            raise APIException('targets must be a non empty list', 400)
+        if len(targets) > MAX_TARGETS:
+            raise APIException('too many targets (maximum {})'
+                               .format(MAX_TARGETS), 400)
+        targets = [target_of(target) for target in targets]
+        if len(set(target['name'] for target in targets)) < len(targets):
+            raise APIException('duplicated targets', 400)
+        for target in targets:
+            if endpoint not in ENDPOINTS[target['service'].type]:
+                raise APIException(
+                    'service {} of type {!r} has no endpoint /{}'
+                    .format(target['name'], target['service'].type,
+                            endpoint), 400)
+        return endpoint, args, targets
+
+
+def target_of(spec):
+    """Parse the description ``spec`` of a target of a federated query.
+
+    :type spec: str|dict
+    :rtype: dict
+    """
+    if not isinstance(spec, dict):
+        spec = {'service': spec}
+    try:
+        namespace, service = spec['service'].split('/')
+    except (KeyError, AttributeError, ValueError):
+        raise APIException('targets must be given as namespace/service',
+                           400)
+    srv = get_service(namespace, service)
+    if srv.type not in ENDPOINTS:
+        raise APIException('service {} of type {!r} cannot be federated'
+                           .format(spec['service'], srv.type), 400)
+    timeout = spec.get('timeout', srv.timeout)
+    if (not isinstance(timeout, numbers.Real) or isinstance(timeout, bool) or
+            timeout <= 0):
+        raise APIException('timeout of {} must be a positive number'
+                           .format(spec['service']), 400)
+    return {
+        'name': spec['service'],
+        'service': srv,
+        'timeout': timeout,
+        'prov': store_prov({'sources': srv.sources})
+    }
+
+
+def federate(targets, endpoint, args, req):
+    """Produce the results of all the ``targets`` as they arrive.
+
+    Each target is queried in its own thread.  A target that doesn't
+    finish within its timeout is reported as such, and its thread stops
+    at its next result.
+
+    """
+    queue = Queue.Queue(maxsize=RESULTS_PER_TARGET * len(targets))
+    done = threading.Event()
+    now = time.time()
+    deadlines = {}
+    services = {}
+    for target in targets:
+        deadlines[target['name']] = now + target['timeout']
+        services[target['name']] = target
+        thread = threading.Thread(
+            target=run_target,
+            args=(target, endpoint, args, req,
+                  deadlines[target['name']], queue, done),
+            name='federate {}'.format(target['name']))
+        thread.daemon = True
+        thread.start()
+    statuses = {}
+    try:
+        while len(statuses) < len(targets):
+            pending = [name for name in deadlines if name not in statuses]
+            wait = min(deadlines[name] for name in pending) - time.time()
+            try:
+                name, kind, value = queue.get(timeout=max(wait, 0))
+            except Queue.Empty:
+                for name in pending:
+                    if deadlines[name] <= time.time():
+                        statuses[name] = 'timeout'
+                        yield line(name, status='timeout',
+                                   error='no answer in time',
+                                   prov=prov_url(services[name]))
+                continue
+            if name in statuses:
+                # a late result of a target that timed out
+                continue
+            if kind == RESULT:
+                # results are already JSON
+                yield '{{"source": {}, "result": {}}}\n'.format(
+                    json.dumps(name), value)
+            else:
+                statuses[name] = value['status']
+                yield line(name,
+                           prov=prov_url(services[name],
+                                         value.pop('prov', None)),
+                           **value)
+        yield json.dumps({'_metadata': {'targets': statuses},
+                          '_status': 'success'}) + '\n'
+    finally:
+        done.set()
+
+
+def run_target(target, endpoint, args, req, deadline, queue, done):
+    """Put the results of ``target`` in ``queue``.
+
+    Stop as soon as ``done`` is set or ``deadline`` passes.
+
+    """
+    name = target['name']
+    try:
+        results, metadata, stop, prov = target['service'].results(
+            endpoint, args, req)
+        for result in results:
+            if not put(queue, (name, RESULT, result), done, deadline):
+                stop()
+                return
+        put(queue, (name, END, {
+            'status': 'success',
+            'metadata': formats.metadata_fields(metadata()),
+            'prov': prov
+        }), done, deadline)
+    except Exception as exc:
+        put(queue, (name, END, {'status': 'error', 'error': str(exc)}),
+            done, deadline)
+
+
+def put(queue, item, done, deadline):
+    """Put ``item`` in ``queue``, waiting while it's full.
+
+    Return False if ``done`` is set or ``deadline`` passes first.
+
+    """
+    while not done.is_set() and time.time() <= deadline:
+        try:
+            queue.put(item, timeout=POLL_INTERVAL)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def prov_url(target, key=None):
+    """Url of the provenance ``key`` or, by default, of the sources."""
+
+    return target['service'].prov_url(key or target['prov'])
+
+
+def line(name, **fields):
+    return json.dumps(dict(fields, source=name)) + '\n'
@@ -1,48 +1,118 @@
+"""Firewall of the workers.
+
+Workers can only reach the ip's in the whitelist of their service (plus
+the queue and the name servers).  The rules are installed in the
+network namespace of each worker with a single ``iptables-restore``,
+which replaces the whole ``filter`` table at once.
+
+Resolved addresses, and the rules for a given whitelist, are cached for
+``DNS_TTL`` seconds, so the workers of a service (and services with the
+same whitelist) don't resolve the same names again.
+
+"""
+
+import os
 import socket
 import subprocess
+import threading
+import time
+
+from .docker import container_pid
+from .config import Config, get_option
+
 
-from .docker import docker_output
-from .config import Config
+# Seconds to keep resolved addresses and rulesets
+DNS_TTL = get_option('firewall', 'dns_ttl', 300)
+
+# Caches: address -> (expiration, ips), whitelist -> (expiration, rules)
+_resolved = {}
+_rulesets = {}
+_lock = threading.Lock()
 
 
 def allow(worker, whitelist):
     """Allow access of worker to ip's in whitelist."""
 
-    whitelist = list(resolve(whitelist if whitelist is not None else []))
-    whitelist.append(Config.get('queue', 'host'))
-    whitelist.extend(get_nameservers())
+    rules = ruleset(whitelist if whitelist is not None else [])
     pid = get_pid(worker)
     host_dir = Config.get('server', 'host_dir')
-    print 'vars:', host_dir, ' ... ', pid 
     ensure_namespace_link(host_dir, pid)
-    run(pid, 'iptables -A OUTPUT -s 0/0 -d 0/0 -j DROP')
-    for ip in whitelist:
-        run(pid, 'iptables -I OUTPUT 1 -s 0/0 -d {0} -j ACCEPT'.format(ip))
+    restore(pid, rules)
+
+
+def ruleset(whitelist):
+    """Return the rules for ``iptables-restore`` allowing ``whitelist``.
+
+    :type whitelist: Iterable[str]
+    :rtype: str
+    """
+    addresses = set(whitelist)
+    addresses.add(Config.get('queue', 'host'))
+    addresses.update(get_nameservers())
+    key = tuple(sorted(addresses))
+    now = time.time()
+    with _lock:
+        cached = _rulesets.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    ips = sorted(set(resolve(addresses)))
+    rules = '\n'.join(
+        ['*filter',
+         ':INPUT ACCEPT [0:0]',
+         ':FORWARD ACCEPT [0:0]',
+         ':OUTPUT ACCEPT [0:0]'] +
+        ['-A OUTPUT -d {0} -j ACCEPT'.format(ip) for ip in ips] +
+        ['-A OUTPUT -j DROP',
+         'COMMIT', ''])
+    with _lock:
+        _rulesets[key] = (now + DNS_TTL, rules)
+    return rules
 
 
 def resolve(addresses):
     """Convert names to ip's."""
 
     for addr in addresses:
-        _, _, ips = socket.gethostbyname_ex(addr)
-        for ip in ips:
+        for ip in resolve_address(addr):
             yield ip
 
 
+def resolve_address(addr):
+    """Return the ip's of ``addr``, caching them for ``DNS_TTL`` seconds.
+
+    :rtype: list[str]
+    """
+    now = time.time()
+    with _lock:
+        cached = _resolved.get(addr)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    _, _, ips = socket.gethostbyname_ex(addr)
+    with _lock:
+        _resolved[addr] = (now + DNS_TTL, ips)
+    return ips
+
+
 def get_pid(worker):
-    return docker_output('inspect', '-f', '{{.State.Pid}}', worker).strip()
+    return container_pid(worker)
 
 
 def ensure_namespace_link(host_dir, pid):
-    subprocess.check_call(
-        'ln -sf {host_dir}/proc/{pid}/ns/net /var/run/netns/{pid}'
-        .format(**locals()).split())
+    link = '/var/run/netns/{}'.format(pid)
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink('{}/proc/{}/ns/net'.format(host_dir, pid), link)
+
 
+def restore(pid, rules):
+    """Replace the filter table in the network namespace of ``pid``."""
 
-def run(pid, command):
-    return subprocess.check_output(
-        'sudo ip netns exec {pid} {command}'
-        .format(**locals()).split())
+    cmd = 'sudo ip netns exec {} iptables-restore'.format(pid).split()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, _ = proc.communicate(rules)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
 
 
 def get_nameservers():
@@ -50,4 +120,3 @@ def get_nameservers():
     for line in nameservers:
         if line.startswith('nameserver'):
             yield line.split()[1]
-
@@ -0,0 +1,221 @@
+"""Output formats for the results of ``query`` and ``map_filter`` adapters.
+
+The format is selected with the query parameter ``_format`` or,
+failing that, with the ``Accept`` header.  Besides the default JSON
+document (see ``service.result_generator``), results can be streamed
+as:
+
+- newline delimited JSON (``ndjson``), with the metadata in a trailing
+  line,
+- comma or tab separated values (``csv`` and ``tsv``), with the columns
+  declared in the ``response`` of the endpoint, and the metadata in a
+  trailing comment line (``#`` followed by a JSON object), and
+- a stream of msgpack objects (``msgpack``), with the metadata in a
+  trailing object.
+
+"""
+
+import csv
+import cStringIO
+import itertools
+import json
+import traceback
+
+import msgpack
+
+from .api import APIException
+
+
+# Start of the trailing line of the delimited formats
+COMMENT = '# '
+
+# Formats, in order of preference
+FORMATS = ['json', 'ndjson', 'csv', 'tsv', 'msgpack']
+
+MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'tsv': 'text/tab-separated-values',
+    'msgpack': 'application/x-msgpack'
+}
+
+DELIMITERS = {
+    'csv': ',',
+    'tsv': '\t'
+}
+
+
+class Stream(object):
+    """Chunks of the body of a response, which may end in an error.
+
+    ``produce(stream)`` is a generator function producing the chunks.
+    It sets ``stream.failed`` if the body ends with an error report,
+    so the wrappers of the body (cache, coalescing) don't keep it.
+
+    """
+
+    def __init__(self, produce):
+        self.failed = False
+        self._chunks = produce(self)
+
+    def __iter__(self):
+        return self._chunks
+
+    def close(self):
+        self._chunks.close()
+
+
+def failed(chunks):
+    """True if the body ``chunks`` (see ``Stream``) ended in an error."""
+
+    return getattr(chunks, 'failed', False)
+
+
+def negotiate(req):
+    """Return the output format for the request ``req``.
+
+    :type req: flask.Request
+    :rtype: str
+    """
+    fmt = req.args.get('_format')
+    if fmt is not None:
+        if fmt not in MIMETYPES:
+            raise APIException('unknown format: {} (use one of: {})'
+                               .format(fmt, ', '.join(FORMATS)), 400)
+        return fmt
+    mimetype = req.accept_mimetypes.best_match(
+        [MIMETYPES[fmt] for fmt in FORMATS])
+    for fmt in FORMATS:
+        if MIMETYPES[fmt] == mimetype:
+            return fmt
+    return 'json'
+
+
+def metadata_fields(md):
+    """Select the fields of the metadata ``md`` shown to the client."""
+
+    fields = {
+        'time_in_main': md.get('time_in_main', None),
+        'cache': md.get('cache', None),
+        'telemetry': md.get('telemetry', None)
+    }
+    if 'next_cursor' in md:
+        fields['next_cursor'] = md['next_cursor']
+    return fields
+
+
+def encode(fmt, results, metadata, cancel=None, columns=None,
+           stream=None):
+    """Encode ``results`` in the format ``fmt``.
+
+    Arguments are as in ``service.result_generator``.  ``columns`` are
+    the columns for the delimited formats; by default, the keys of the
+    first result.
+
+    Errors are reported with a last object ``{"_status": "error",
+    "_error": traceback}``, which in the delimited formats is written
+    in a comment line, as the metadata.
+
+    """
+    exhausted = []
+
+    def tracked():
+        for result in results:
+            yield result
+        exhausted.append(True)
+
+    try:
+        if fmt in DELIMITERS:
+            for chunk in delimited(tracked(), DELIMITERS[fmt], columns):
+                yield chunk
+            yield comment(trailer(metadata()))
+            return
+        if fmt == 'msgpack':
+            for result in tracked():
+                yield msgpack.packb(json.loads(result))
+            yield msgpack.packb(trailer(metadata()))
+        else:
+            for result in tracked():
+                yield result + '\n'
+            yield json.dumps(trailer(metadata())) + '\n'
+    except GeneratorExit:
+        if not exhausted and cancel is not None:
+            cancel()
+        raise
+    except Exception:
+        exc = traceback.format_exc()
+        if stream is not None:
+            stream.failed = True
+        yield error_report(fmt, exc)
+
+
+def trailer(md):
+    """Last object of a stream, with the metadata ``md``."""
+
+    return {'_metadata': metadata_fields(md), '_status': 'success'}
+
+
+def error_trailer(exc):
+    """Last object of a stream ending with the error ``exc``."""
+
+    return {'_status': 'error', '_error': exc}
+
+
+def error_report(fmt, exc):
+    """Last chunk of a body in the format ``fmt`` ending with ``exc``.
+
+    The JSON document ends, as in ``service.result_generator``, with a
+    line ``---`` followed by the error.
+
+    """
+    if fmt == 'msgpack':
+        return msgpack.packb(error_trailer(exc))
+    if fmt == 'ndjson':
+        return json.dumps(error_trailer(exc)) + '\n'
+    if fmt in DELIMITERS:
+        return comment(error_trailer(exc))
+    return '---\n' + exc
+
+
+def comment(obj):
+    """Trailing line of a delimited file, with the JSON for ``obj``."""
+
+    return COMMENT + json.dumps(obj) + '\n'
+
+
+def delimited(results, delimiter, columns=None):
+    """Produce ``results`` as rows of delimited values."""
+
+    out = cStringIO.StringIO()
+    writer = csv.writer(out, delimiter=delimiter, lineterminator='\n')
+    objs = itertools.imap(json.loads, results)
+    if columns is None:
+        first = next(objs, None)
+        if first is None:
+            return
+        columns = sorted(first) if isinstance(first, dict) else ['value']
+        objs = itertools.chain([first], objs)
+    writer.writerow([cell(column) for column in columns])
+    yield out.getvalue()
+    out.seek(0)
+    out.truncate()
+    for obj in objs:
+        if not isinstance(obj, dict):
+            obj = {'value': obj}
+        writer.writerow([cell(obj.get(column)) for column in columns])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+
+def cell(value):
+    """Text for ``value`` in a delimited file."""
+
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (dict, list, bool)):
+        return json.dumps(value)
+    return value
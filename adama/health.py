@@ -3,8 +3,7 @@ from flask.ext import restful
 from .api import ok
 from .service import get_service
 from .services import all_services
-from .command.worker_monitor import (workers_ready_for, workers_total,
-                                     queue_size)
+from .command.worker_monitor import worker_state, queue_size
 
 
 class ServiceHealthResource(restful.Resource):
@@ -52,8 +51,9 @@ def health(srv):
     :type srv: Service
     :rtype: Dict[str, int]
     """
+    states = filter(None, map(worker_state, srv.workers))
     return {
-        'total_workers': workers_total(srv.iden),
-        'workers_free': workers_ready_for(srv.iden),
+        'total_workers': len(states),
+        'workers_free': len([st for st in states if st['state'] == 'idle']),
         'queue_size': queue_size(srv.iden)
     }
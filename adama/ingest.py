@@ -0,0 +1,83 @@
+"""Streaming ingestion of the records of an upstream response.
+
+Used by ``map_filter`` adapters to feed the records of the third party
+service to the workers while they are still being downloaded.
+
+"""
+
+import importlib
+import json
+
+
+# Size of the reads from the upstream connection
+CHUNK_SIZE = 64 * 1024
+
+# Content types of upstreams producing one JSON object per line
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson',
+                'application/jsonl', 'application/x-jsonlines')
+
+
+def fastest_ijson():
+    """Return the fastest ijson backend available."""
+
+    for backend in ('yajl2_c', 'yajl2', 'python'):
+        try:
+            return importlib.import_module('ijson.backends.' + backend)
+        except (ImportError, OSError):
+            # the yajl backends need the C library (and, for yajl2_c,
+            # the compiled extension)
+            continue
+    raise ImportError('no ijson backend available')
+
+
+ijson = fastest_ijson()
+
+
+class FileLikeWrapper(object):
+    """File-like access to the (decoded) body of a streamed ``response``.
+
+    ``read`` hands over the chunks coming from the connection as they
+    are, only splitting them when they are longer than requested.
+
+    """
+
+    def __init__(self, response, chunk_size=CHUNK_SIZE):
+        self.chunks = response.iter_content(chunk_size=chunk_size)
+        self.buffer = ''
+
+    def read(self, n=CHUNK_SIZE):
+        if not self.buffer:
+            self.buffer = next(self.chunks, '')
+        if len(self.buffer) <= n:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+
+def is_ndjson(response, upstream_format=None):
+    """True if the body of ``response`` is newline delimited JSON.
+
+    Use ``upstream_format`` ('json' or 'ndjson') if given, or guess from
+    the content type otherwise.
+
+    """
+    if upstream_format:
+        return upstream_format == 'ndjson'
+    content_type = response.headers.get('Content-Type', '')
+    return content_type.split(';')[0].strip().lower() in NDJSON_TYPES
+
+
+def records(response, json_path='', upstream_format=None):
+    """Iterate over the JSON objects in the body of ``response``.
+
+    For a JSON body, the objects are the elements of the array located at
+    ``json_path``.  For a NDJSON body, each non empty line is an object.
+
+    """
+    if is_ndjson(response, upstream_format):
+        return (json.loads(line)
+                for line in response.iter_lines(chunk_size=CHUNK_SIZE)
+                if line.strip())
+    path = '.'.join(filter(None, [json_path, 'item']))
+    return ijson.items(FileLikeWrapper(response), path)
@@ -0,0 +1,304 @@
+"""Queue of registration jobs.
+
+Registering a service (building its image and starting its workers) is
+expensive, so registrations are queued in Redis and run by a bounded
+number of runner processes, shared by all the processes of the API
+server:
+
+- at most ``BUILD_CONCURRENCY`` jobs build images, and at most
+  ``START_CONCURRENCY`` start workers, at the same time,
+- jobs are taken from the namespaces in turn, so a burst of
+  registrations in one namespace doesn't hold back the others,
+- a job can be cancelled while it's queued, or in between its stages,
+  and
+- the changes of state of a job are published, so clients can follow
+  them as Server-Sent Events (see ``events``).
+
+"""
+
+from contextlib import contextmanager
+import cPickle
+import json
+import multiprocessing
+import threading
+import time
+import traceback
+import uuid
+
+import redis
+
+from .api import APIException
+from .config import Config, get_option
+
+
+# Redis database for the queue of jobs
+JOBS_DB = 14
+# Jobs building images at the same time
+BUILD_CONCURRENCY = get_option('registration', 'build_concurrency', 2)
+# Jobs starting workers at the same time
+START_CONCURRENCY = get_option('registration', 'start_concurrency', 2)
+# Slots for each stage of a job
+STAGE_LIMITS = {'build': BUILD_CONCURRENCY, 'start': START_CONCURRENCY}
+# Runner processes (so builds and starts of different jobs overlap)
+CONCURRENCY = BUILD_CONCURRENCY + START_CONCURRENCY
+# Maximum number of queued jobs
+MAX_QUEUED = get_option('registration', 'max_queued', 100)
+# Seconds a slot is held by a runner that died without releasing it
+SLOT_TTL = 60
+# Seconds in between checks of a free slot or a new event
+POLL_INTERVAL = 0.5
+# Seconds in between comments keeping an event stream open
+KEEPALIVE = 15
+# Seconds an event stream lasts (each one holds a process of the server)
+EVENTS_TIMEOUT = get_option('registration', 'events_timeout', 300)
+# Milliseconds clients wait before reconnecting to an ended event stream
+EVENTS_RETRY = 1000
+
+PENDING = 'jobs:pending'
+NAMESPACES = 'jobs:namespaces'
+
+_db = redis.StrictRedis(host=Config.get('store', 'host'),
+                        port=Config.getint('store', 'port'),
+                        db=JOBS_DB)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _queue(namespace):
+    return 'jobs:ns:{}'.format(namespace)
+
+
+def _job(iden):
+    return 'jobs:job:{}'.format(iden)
+
+
+def _cancel(iden):
+    return 'jobs:cancel:{}'.format(iden)
+
+
+def _channel(iden):
+    return 'jobs:events:{}'.format(iden)
+
+
+def submit(namespace, iden, func, *args):
+    """Queue the job ``iden`` of ``namespace``, to run ``func(*args)``.
+
+    ``func`` and ``args`` must be picklable, since the job is run in
+    another process.
+
+    """
+    if _db.scard(PENDING) >= MAX_QUEUED:
+        raise APIException('too many registrations in progress, '
+                           'try again later', 503)
+    _db.delete(_cancel(iden))
+    _db.set(_job(iden), cPickle.dumps((func, args)))
+    _db.sadd(PENDING, iden)
+    if _db.rpush(_queue(namespace), iden) == 1:
+        _db.rpush(NAMESPACES, namespace)
+    dispatch()
+
+
+def cancel(namespace, iden):
+    """Cancel the job ``iden``.
+
+    Return True if the job was still queued (and it's now removed).  A
+    running job is flagged, and it stops at its next stage.
+
+    """
+    if _db.lrem(_queue(namespace), 0, iden):
+        _db.delete(_job(iden))
+        _db.srem(PENDING, iden)
+        return True
+    _db.setex(_cancel(iden), SLOT_TTL * 10, 1)
+    return False
+
+
+def check_cancelled(iden):
+    """Raise ``JobCancelled`` if the job ``iden`` was cancelled."""
+
+    if _db.exists(_cancel(iden)):
+        raise JobCancelled('registration cancelled')
+
+
+def publish(iden, state):
+    """Publish the new ``state`` (a dictionary) of the job ``iden``."""
+
+    _db.publish(_channel(iden), json.dumps(state))
+
+
+def events(iden, current):
+    """Stream the states of the job ``iden`` as Server-Sent Events.
+
+    ``current()`` returns the current state of the job, or None if
+    there is no such job.  The stream ends once the job is done, or
+    after ``EVENTS_TIMEOUT`` seconds (clients reconnect then, and get
+    the current state again).
+
+    """
+    pubsub = _db.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(_channel(iden))
+    try:
+        # subscribe before reading the state, so no change is lost
+        state = current()
+        yield 'retry: {}\n'.format(EVENTS_RETRY) + event(state)
+        last = time.time()
+        deadline = last + EVENTS_TIMEOUT
+        while (state is not None and state.get('slot') == 'busy' and
+               time.time() < deadline):
+            message = pubsub.get_message()
+            if message is None:
+                if time.time() - last > KEEPALIVE:
+                    last = time.time()
+                    yield ': keepalive\n\n'
+                time.sleep(POLL_INTERVAL)
+                continue
+            state = json.loads(message['data'])
+            last = time.time()
+            yield event(state)
+    finally:
+        pubsub.close()
+
+
+def event(state):
+    """Format ``state`` as a Server-Sent Event."""
+
+    if state is None:
+        return 'event: deleted\ndata: {}\n\n'
+    return 'event: {}\ndata: {}\n\n'.format(
+        state.get('slot', 'busy'), json.dumps(state))
+
+
+class Semaphore(object):
+    """Counting semaphore shared by all processes, held in Redis.
+
+    Each of the ``limit`` slots is a key with a TTL, refreshed while
+    its holder lives (see ``_keep_alive``), so the slots of a crashed
+    process are released eventually.
+
+    """
+
+    # semaphores held by this process
+    held = set()
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.token = uuid.uuid4().hex
+        self.key = None
+
+    def acquire(self, blocking=True, check=None):
+        """Take a slot, waiting for one if ``blocking``.
+
+        ``check`` is called while waiting (for example, to abort).
+
+        """
+        while True:
+            for i in range(self.limit):
+                key = 'jobs:slot:{}:{}'.format(self.name, i)
+                if _db.set(key, self.token, nx=True, ex=SLOT_TTL):
+                    self.key = key
+                    Semaphore.held.add(self)
+                    return True
+            if not blocking:
+                return False
+            if check is not None:
+                check()
+            time.sleep(POLL_INTERVAL)
+
+    def refresh(self):
+        if self.key is not None:
+            _db.expire(self.key, SLOT_TTL)
+
+    def release(self):
+        Semaphore.held.discard(self)
+        if self.key is not None and _db.get(self.key) == self.token:
+            _db.delete(self.key)
+        self.key = None
+
+
+@contextmanager
+def stage(iden, name):
+    """Run a stage ``name`` of the job ``iden`` holding one of its slots.
+
+    Wait for a free slot, unless the job is cancelled meanwhile.
+
+    """
+    check_cancelled(iden)
+    semaphore = Semaphore(name, STAGE_LIMITS[name])
+    semaphore.acquire(check=lambda: check_cancelled(iden))
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def dispatch():
+    """Start a runner if there are queued jobs and room for it."""
+
+    if not _db.scard(PENDING):
+        return
+    runner = Semaphore('runner', CONCURRENCY)
+    if not runner.acquire(blocking=False):
+        return
+    proc = multiprocessing.Process(name='Registration jobs',
+                                   target=_run, args=(runner,))
+    proc.start()
+    # the slot is kept alive by the runner
+    Semaphore.held.discard(runner)
+
+
+def _run(runner):
+    """Run queued jobs until there are none left."""
+
+    Semaphore.held = set([runner])
+    keeper = threading.Thread(target=_keep_alive, name='Job slots')
+    keeper.daemon = True
+    keeper.start()
+    while True:
+        job = _next_job()
+        if job is None:
+            runner.release()
+            # a job queued while releasing the runner would be left
+            # waiting, so look again
+            if not _db.scard(PENDING) or not runner.acquire(blocking=False):
+                return
+            continue
+        iden, func, args = job
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            _db.delete(_cancel(iden))
+
+
+def _next_job():
+    """Take the next job, going through the namespaces in turn.
+
+    :rtype: (str, callable, tuple)|None
+    """
+    while True:
+        namespace = _db.lpop(NAMESPACES)
+        if namespace is None:
+            return None
+        iden = _db.lpop(_queue(namespace))
+        if _db.llen(_queue(namespace)):
+            _db.rpush(NAMESPACES, namespace)
+        if iden is None:
+            continue
+        payload = _db.get(_job(iden))
+        _db.delete(_job(iden))
+        _db.srem(PENDING, iden)
+        if payload is None:
+            continue
+        func, args = cPickle.loads(payload)
+        return iden, func, args
+
+
+def _keep_alive():
+    while True:
+        for semaphore in list(Semaphore.held):
+            semaphore.refresh()
+        time.sleep(SLOT_TTL / 3.0)
@@ -0,0 +1,197 @@
+"""Cache of the responses of the adapters.
+
+Services declaring ``cache_ttl`` in their metadata get the responses to
+their GET requests cached in Redis, compressed, for ``cache_ttl``
+seconds.  A cached response is streamed straight from Redis, without
+sending any message to the workers.
+
+"""
+
+import hashlib
+import json
+import uuid
+import zlib
+
+from flask import g, Response
+import redis
+
+from .config import Config, get_option
+from . import formats
+
+
+# Redis database for the cached responses
+CACHE_DB = 11
+# Responses larger than this are not cached
+MAX_SIZE = get_option('response_cache', 'max_size', 10 * 2**20)
+# Size of the chunks streamed from a cached response
+CHUNK_SIZE = 64 * 1024
+
+# Headers of the request that select a different response
+VARYING_HEADERS = ('Range', 'If-Range')
+# Headers that are not saved with the response
+UNCACHED_HEADERS = ('content-length', 'set-cookie', 'etag', 'connection',
+                    'keep-alive', 'transfer-encoding')
+
+_db = redis.StrictRedis(host=Config.get('store', 'host'),
+                        port=Config.getint('store', 'port'),
+                        db=CACHE_DB)
+
+
+def ttl_of(service, req):
+    """Time to live of the response to ``req``, or 0 if not cacheable.
+
+    :type req: flask.Request
+    :rtype: int
+    """
+    if req.method != 'GET':
+        return 0
+    return getattr(service, 'cache_ttl', 0) or 0
+
+
+def cache_key(service, endpoint, req, per_user=None):
+    """Key for the response to ``req`` at ``endpoint`` of ``service``.
+
+    The query arguments are normalized (sorted), the output format and
+    the ``VARYING_HEADERS`` are part of the key, and so is the user if
+    ``per_user`` (by default, if the service declares
+    ``cache_per_user``).
+
+    :type endpoint: str
+    :type req: flask.Request
+    :type per_user: bool|None
+    :rtype: str
+    """
+    args = sorted(req.args.items(multi=True))
+    if per_user is None:
+        per_user = getattr(service, 'cache_per_user', False)
+    user = getattr(g, 'user', 'anonymous') if per_user else None
+    headers = [req.headers.get(header) for header in VARYING_HEADERS]
+    digest = hashlib.sha1(json.dumps(
+        [endpoint, args, user, formats.negotiate(req), headers])).hexdigest()
+    return '{}:{}'.format(service.iden, digest)
+
+
+def lookup(service, endpoint, req):
+    """Return the cached response to ``req``, or None.
+
+    Answer with ``304 Not Modified`` if the client already has the
+    cached version (``If-None-Match``).
+
+    :rtype: flask.Response|None
+    """
+    if not ttl_of(service, req):
+        return None
+    try:
+        entry = _db.hgetall(cache_key(service, endpoint, req))
+    except redis.RedisError:
+        # the cache is an optimization: just go to the workers
+        return None
+    if not entry:
+        return None
+    if req.if_none_match.contains(entry['etag']):
+        response = Response(status=304)
+    else:
+        response = Response(decompress(entry['body']),
+                            status=int(entry['status']),
+                            headers=json.loads(entry['headers']),
+                            direct_passthrough=True)
+        response.headers['Content-Length'] = entry['length']
+    response.set_etag(entry['etag'])
+    response.headers['X-Adama-Cache'] = 'hit'
+    return response
+
+
+def save(service, endpoint, req, response):
+    """Cache ``response`` while it's streamed to the client.
+
+    Only complete and successful (``200``) responses are saved.  The
+    response gets a new ETag, saved with it.  Return the response to
+    send to the client.
+
+    :rtype: flask.Response
+    """
+    ttl = ttl_of(service, req)
+    if (not ttl or response.status_code != 200 or
+            not getattr(response, 'cacheable', True)):
+        return response
+    headers = [(header, value) for header, value in response.headers.items()
+               if header.lower() not in UNCACHED_HEADERS]
+    chunks = response.response
+    key = cache_key(service, endpoint, req)
+    etag = uuid.uuid4().hex
+    response.response = formats.Stream(lambda stream: _tee(
+        stream, chunks, key, ttl, response.status_code, headers, etag))
+    response.set_etag(etag)
+    response.headers['X-Adama-Cache'] = 'miss'
+    return response
+
+
+def invalidate(iden):
+    """Remove all the cached responses of the service ``iden``.
+
+    :type iden: str
+    """
+    try:
+        keys = list(_db.scan_iter(match='{}:*'.format(iden)))
+        if keys:
+            _db.delete(*keys)
+    except redis.RedisError:
+        pass
+
+
+def _tee(stream, chunks, key, ttl, status, headers, etag):
+    """Produce ``chunks`` while saving them, compressed, under ``key``.
+
+    The saved response has the ETag ``etag`` sent with the original one.
+
+    ``chunks`` are not saved if they end in an error (see
+    ``formats.Stream``), which is passed on to ``stream``.
+
+    """
+    compressor = zlib.compressobj()
+    parts = []
+    size = 0
+    complete = False
+    try:
+        for chunk in chunks:
+            yield chunk
+            if size is None:
+                continue
+            size += len(chunk)
+            if size > MAX_SIZE:
+                size = None
+                parts = []
+                continue
+            parts.append(compressor.compress(chunk))
+        complete = True
+    finally:
+        stream.failed = formats.failed(chunks)
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            # propagate a disconnection of the client to the producer
+            close()
+        if complete and size is not None and not stream.failed:
+            parts.append(compressor.flush())
+            try:
+                _db.pipeline().hmset(key, {
+                    'body': ''.join(parts),
+                    'etag': etag,
+                    'length': size,
+                    'status': status,
+                    'headers': json.dumps(headers)
+                }).expire(key, ttl).execute()
+            except redis.RedisError:
+                pass
+
+
+def decompress(body):
+    """Produce the decompressed ``body`` in chunks."""
+
+    decompressor = zlib.decompressobj()
+    for i in range(0, len(body), CHUNK_SIZE):
+        chunk = decompressor.decompress(body[i:i + CHUNK_SIZE])
+        if chunk:
+            yield chunk
+    rest = decompressor.flush()
+    if rest:
+        yield rest
@@ -19,7 +19,8 @@ from .namespaces import NamespacesResource
 from .namespace import NamespaceResource
 from .services import ServicesResource
 from .service import (ServiceResource, ServiceQueryResource,
-                      ServiceListResource,
+                      ServiceListResource, ServiceBatchResource,
+                      ServiceRegistrationResource,
                       IconResource, StatsResource)
 from .passthrough import PassthroughServiceResource
 from .servicedocs import ServiceDocsResource, ServiceDocsUIResource
@@ -28,6 +29,7 @@ from .stores import token_store
 from .tools import location_of, get_token
 from .provenance import ProvResource
 from .debug import DebugResource
+from .federation import FederationResource
 from .health import ServiceHealthResource, GeneralHealthResource
 
 
@@ -47,6 +49,8 @@ api.add_resource(StatusResource, url('/status'),
                  endpoint='status')
 api.add_resource(GeneralHealthResource, url('/health'),
                  endpoint='general_health')
+api.add_resource(FederationResource, url('/federate'),
+                 endpoint='federate')
 api.add_resource(NamespaceResource, url('/<string:namespace>'),
                  endpoint='namespace')
 api.add_resource(ServicesResource, url('/<string:namespace>/services'),
@@ -59,6 +63,12 @@ api.add_resource(ServiceQueryResource,
 api.add_resource(ServiceListResource,
                  url('/<string:namespace>/<string:service>/list'),
                  endpoint='list')
+api.add_resource(ServiceBatchResource,
+                 url('/<string:namespace>/<string:service>/batch'),
+                 endpoint='batch')
+api.add_resource(ServiceRegistrationResource,
+                 url('/<string:namespace>/<string:service>/registration'),
+                 endpoint='registration')
 api.add_resource(PassthroughServiceResource,
                  url('/<string:namespace>/<string:service>/access'),
                  url('/<string:namespace>/<string:service>/access/'
@@ -1,52 +1,62 @@
 import base64
+import collections
 import datetime
 import glob
+import hashlib
 import itertools
 import json
-import multiprocessing
+import multiprocessing.pool
 import os
+import Queue
 import re
-import ssl
-import socket
+import shutil
 import subprocess
 import tarfile
 import textwrap
+import time
 import tempfile
 import threading
 import traceback
-import uuid
 import urlparse
 import zipfile
 import cStringIO
 
 from enum import Enum
-from flask import request, Response, g
+from flask import request, Response, g, stream_with_context
 from flask.ext import restful
 import jinja2
 import requests
-import ijson
 import yaml
-from werkzeug.datastructures import FileStorage
+from werkzeug.datastructures import FileStorage, MultiDict
 import pyswagger
 import pyswagger.getter
+import redis
 from PIL import Image
 
 from . import app
 from .requestparser import RequestParser
 from .api import APIException, RegisterException, ok, api_url_for, error
-from .config import Config
-from .docker import docker_output, start_container, tail_logs, safe_docker
-from .firewall import allow, get_nameservers
+from .config import Config, get_option
+from .docker import (build_image, image_exists, image_id, tag_image,
+                     start_container, exec_in, stop_container,
+                     remove_container, kill_container, copy_into,
+                     Logs, logs as container_logs)
+from .firewall import allow, get_nameservers, resolve_address
+from .ingest import records
+from . import (sessions, response_cache, coalesce, formats, validation,
+               jobs)
 from .tools import (location_of, identifier, service_iden,
-                    adapter_iden, interleave)
+                    adapter_iden, interleave, chunks)
 from .tasks import Producer
-from .stores import service_store, prov_store, stats_store
+from .stores import (service_store, prov_store, stats_store, namespace_store,
+                     adapter_cache_store)
 from .swagger import swagger
 from .namespace import DeleteResponseModel
 from .tools import chdir, get_token
 from .entity import get_permissions
 from .parameters import fix_metadata, metadata_to_swagger
 from .stats import tick, get_total_access, get_unique_access, get_users
+from .command.worker_monitor import is_up, last_heartbeat
 
 
 LANGUAGES = {
@@ -72,9 +82,62 @@ ZIPS = ['.zip']
 # declaring them dead
 TIMEOUT = 10  # second
 
+# Time to watch for errors after all the workers reported they started
+STARTED_GRACE = 1  # second
+
+# Lines logged by the workers when they are ready to consume requests
+WORKER_STARTED = '*** WORKER STARTED'
+WORKER_RELOADED = '*** WORKER RELOADED'
+
 # Timout to wait while stopping workers
 STOP_TIMEOUT = 5
 
+# Length of the hashes in the tags of images
+IMAGE_HASH_LENGTH = 16
+
+# Seconds after which an unfinished update no longer blocks new ones
+UPDATE_TIMEOUT = get_option('registration', 'update_timeout', 3600)
+
+# Maximum number of workers of a service starting at the same time
+WORKER_START_CONCURRENCY = get_option('workers', 'start_concurrency', 4)
+
+# Number of upstream records sent to a map_filter worker in one message
+MAP_FILTER_BATCH_SIZE = 100
+
+# Batches in flight per worker of a map_filter service
+MAP_FILTER_BATCHES_PER_WORKER = 2
+
+# First version of the protocol of the workers taking batches of records
+BATCH_PROTOCOL = 2
+
+# Size of the chunks streamed from and to passthrough services
+PASSTHROUGH_CHUNK_SIZE = 64 * 1024
+
+# Headers that apply to a single connection, and can't be forwarded
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-authenticate',
+                      'proxy-authorization', 'te', 'trailers',
+                      'transfer-encoding', 'upgrade')
+
+# Headers always forwarded to passthrough services, to support
+# partial downloads
+RANGE_HEADERS = ('Range', 'If-Range')
+
+# Query parameters selecting a page of results
+PAGE_PARAMS = ('_limit', '_offset', '_cursor')
+
+# Query parameters interpreted by Adama, not forwarded to third parties
+RESERVED_PARAMS = PAGE_PARAMS + ('_format',)
+
+# Results read past the end of a page to get the metadata of a query
+# (its worker stops by itself at the end of the page)
+PAGE_DRAIN = 10
+
+# Maximum number of queries in a batch
+BATCH_MAX_SIZE = 1000
+
+# Queries of a batch in flight per worker of a service
+BATCH_QUERIES_PER_WORKER = 2
+
 HERE = location_of(__file__)
 
 
@@ -99,6 +162,7 @@ class AbstractService(object):
         ('requirements', False, []),
         ('notify', False, ''),
         ('json_path', False, ''),
+        ('upstream_format', False, None),
         ('main_module', False, 'main'),
         ('users', False, {}),
         ('validate_request', False, False),
@@ -113,6 +177,9 @@ class AbstractService(object):
         ('tags', False, []),
         ('metadata', False, METADATA_DEFAULT),
         ('timeout', False, 30),
+        ('cache_ttl', False, 0),
+        ('cache_per_user', False, False),
+        ('coalesce', False, False),
         # private fields (not to be displayed)
         ('_icon', False, None),
         ('_no_firewall', False, None)
@@ -144,6 +211,9 @@ class AbstractService(object):
             raise APIException("'{}' is not a valid service name.\n"
                                "Allowed characters: [a-z0-9_.-]"
                                .format(self.name))
+        if self.validate_response:
+            # fail at registration on a malformed sampling mode
+            validation.sampler(self.validate_response)
 
     def to_json(self):
         return {key[0]: getattr(self, key[0], key[-1])
@@ -234,13 +304,13 @@ class Service(AbstractService):
 
         if self.type == 'passthrough':
             return
+        base_image = requirements_image(self.language, self.requirements)
         render_template(
             os.path.dirname(self.main_module),
             os.path.basename(self.main_module_path),
-            self.language,
-            self.requirements,
+            base_image,
             into=self.code_dir)
-        self.build()
+        self.build(base_image)
 
     def find_main_module(self):
         """Find the path to the ``main_module``."""
@@ -289,20 +359,37 @@ class Service(AbstractService):
             else:
                 policies[addr] = {}
             try:
-                socket.gethostbyname_ex(addr)
+                resolve_address(addr)
             except:
                 raise APIException(
                     "'{}' does not look like an ip or domain name"
                     .format(addr), 400)
         self.whitelist = policies
 
-    def build(self):
+    def build(self, base_image):
+        """Build the image of the service, unless it's already built.
+
+        Images are tagged with the hash of their content (code and
+        Dockerfile) and of the id of ``base_image``, and the current one
+        is tagged as ``latest``.
+
+        """
         if self.type == 'passthrough':
             return
-        with chdir(self.code_dir):
-            safe_docker('build', '-t', self.iden, '.')
+        image = '{}:{}'.format(
+            self.iden, content_hash(self.code_dir, image_id(base_image)))
+        if not image_exists(image):
+            build_image(self.code_dir, image)
+        tag_image(image, self.iden, 'latest')
 
-    def start_workers(self, n=None):
+    def start_workers(self, n=None, progress=None):
+        """Start ``n`` workers, ``WORKER_START_CONCURRENCY`` at a time.
+
+        ``progress(started, n)`` is called each time a worker is up.  If
+        any worker fails to start, the ones already started are removed
+        and the error is raised.
+
+        """
         if self.type == 'passthrough':
             return
         if self.language is None:
@@ -310,7 +397,34 @@ class Service(AbstractService):
         if n is None:
             n = Config.getint(
                 'workers', '{}_instances'.format(self.language))
-        self.workers = [self.start_worker() for _ in range(n)]
+        started = []
+
+        def done(worker):
+            # callbacks run one at a time, in the thread of the pool
+            # handling results
+            started.append(worker)
+            if progress is not None:
+                progress(len(started), n)
+
+        pool = multiprocessing.pool.ThreadPool(
+            max(1, min(n, WORKER_START_CONCURRENCY)))
+        errors = []
+        try:
+            pending = [pool.apply_async(self.start_worker, callback=done)
+                       for _ in range(n)]
+            for result in pending:
+                try:
+                    result.get()
+                except Exception as exc:
+                    errors.append(exc)
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            for worker in started:
+                remove_container(worker)
+            raise errors[0]
+        self.workers = started
 
     def start_worker(self):
         worker = start_container(
@@ -323,9 +437,13 @@ class Service(AbstractService):
             self.iden,
             '--adapter-type',
             self.type)
-        if not getattr(self, '_no_firewall', False):
-            allow(worker, self.whitelist)
-        docker_output('exec', worker, 'touch', '/ready')
+        try:
+            if not getattr(self, '_no_firewall', False):
+                allow(worker, self.whitelist)
+            exec_in(worker, 'touch', '/ready')
+        except Exception:
+            remove_container(worker)
+            raise
         return worker
 
     def stop_workers(self):
@@ -339,44 +457,80 @@ class Service(AbstractService):
         self.workers = []
 
     def async_stop_worker(self, worker):
-        thread = threading.Thread(target=docker_output,
-                                  args=('rm', '-f', worker))
+        thread = threading.Thread(target=remove_container, args=(worker,))
         thread.start()
         return thread
 
-    def check_health(self):
-        """Check that all workers started ok."""
+    def drain_workers(self, workers):
+        """Stop ``workers`` after they finish their current request.
 
+        Workers exit on SIGTERM once the message in progress is
+        answered.  Give them up to ``timeout`` seconds (the maximum
+        duration of a request) before killing them.
+
+        """
+        def drain(worker):
+            stop_container(worker, self.timeout)
+            remove_container(worker)
+
+        threads = [threading.Thread(target=drain, args=(worker,))
+                   for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(self.timeout + STOP_TIMEOUT)
+
+    def reload_workers(self):
+        """Copy ``code_dir`` into the running workers and reload it.
+
+        Workers reload the main module on SIGHUP, in between requests,
+        so they have up to the maximum duration of a request to report
+        the new code is loaded.  Raise ``RegisterException`` if any of
+        them doesn't.
+
+        """
         if self.type == 'passthrough':
-            return True
+            return
+        logs = {}
+        try:
+            # follow the logs before signalling, so no report is missed
+            for worker in self.workers:
+                logs[worker] = Logs(worker, since_now=True)
+            for worker in self.workers:
+                copy_into(worker, self.code_dir, '/root/user_code')
+                kill_container(worker, 'HUP')
+        except Exception:
+            for stream in logs.values():
+                stream.close()
+            raise
+        states = watch_workers(self.workers, self.timeout + TIMEOUT,
+                               logs=logs, ready=WORKER_RELOADED)
+        failed = [worker for worker, state in states.items()
+                  if state != WorkerState.started]
+        if failed:
+            raise RegisterException(
+                len(self.workers),
+                [container_logs(worker) for worker in failed])
 
-        q = multiprocessing.Queue()
+    def check_health(self):
+        """Check that all workers started ok.
 
-        def log(wkr, qq):
-            producer = tail_logs(wkr, timeout=TIMEOUT)
-            v = (check(producer), wkr)
-            qq.put(v)
+        Follow the logs of all the workers at once, and return as soon
+        as all of them report they started (see ``watch_workers``).
 
-        # Ask for logs from workers. We do it in processes so we can
-        # poll for a little while the workers in parallel.
-        ts = []
-        for worker in self.workers:
-            t = multiprocessing.Process(target=log, args=(worker, q),
-                                        name='Worker log {}'.format(worker))
-            t.start()
-            ts.append(t)
-        # wait for all processes (the timeout guarantees they'll finish)
-        for t in ts:
-            t.join()
-
-        logs = []
-        while not q.empty():
-            state, worker = q.get()
-            if state == WorkerState.error:
-                logs.append(docker_output('logs', worker))
+        """
+        if self.type == 'passthrough':
+            return True
 
-        if logs:
-            raise RegisterException(len(self.workers), logs)
+        states = watch_workers(self.workers, TIMEOUT)
+        failed = ([worker for worker, state in states.items()
+                   if state == WorkerState.error] or
+                  [worker for worker, state in states.items()
+                   if state is None])
+        if failed:
+            raise RegisterException(
+                len(self.workers),
+                [container_logs(worker) for worker in failed])
 
     def exec_worker(self, endpoint, args, req):
         """Process a request through the worker."""
@@ -388,34 +542,51 @@ class Service(AbstractService):
 
         tick(self, req, endpoint=endpoint, args=args)
 
+        cached = response_cache.lookup(self, endpoint, req)
+        if cached is not None:
+            return cached
+
         meth = getattr(self, 'exec_worker_{}'.format(self.type))
-        return meth(endpoint, args, req)
+        response = coalesce.run(self, endpoint, req,
+                                lambda: meth(endpoint, args, req))
+        return response_cache.save(self, endpoint, req, response)
 
     def exec_worker_query(self, endpoint, args, req):
         """Send ``args`` to ``queue`` in QueryWorker model."""
 
-        queue = self.iden
-        args['_namespace'] = self.namespace
-        args['_adapter'] = self.adapter_name
-        args['_endpoint'] = endpoint
-        args['_headers'] = dict(req.headers)
-        args['_token'] = get_token(req.headers)
-        args['_url'] = (Config.get('server', 'api_url') +
-                        Config.get('server', 'api_prefix'))
-        args['_queue_host'] = qh = Config.get('queue', 'host')
-        args['_queue_port'] = qp = Config.getint('queue', 'port')
-        args['_store_host'] = Config.get('store', 'host')
-        args['_store_port'] = Config.getint('store', 'port')
-        args['_queue_name'] = queue
-        client = Producer(queue_host=qh, queue_port=qp, queue_name=queue)
-        client.send(args)
+        fmt = formats.negotiate(req)
+        page = Page(args)
+        without_reserved(args)
+        args['_limit'] = page.needed
+        results, metadata, stop, key = self.query_results(endpoint, args,
+                                                          req)
+        response = self.results_response(
+            fmt, endpoint,
+            page.paginate(results, lambda: drain(results, stop)),
+            lambda: dict(metadata(), **page.to_json()),
+            stop)
+        response.headers['Link'] = self.prov_link(key)
+        return response
+
+    def query_results(self, endpoint, args, req):
+        """Send ``args`` to the QueryWorkers and return their results.
+
+        Return a tuple ``(results, metadata, cancel, prov)``: a generator
+        of results (as JSON strings), a function returning the metadata
+        once the results are consumed, a function to stop the worker,
+        and the key of the provenance.
+
+        """
+        client = Producer(queue_host=Config.get('queue', 'host'),
+                          queue_port=Config.getint('queue', 'port'),
+                          queue_name=self.iden)
+        client.send(self.query_message(endpoint, args, req))
         gen = itertools.imap(json.dumps,
                              client.receive(max_wait=self.timeout))
         header = next(gen)
-        key = uuid.uuid4().hex
         header_json = json.loads(header)
         header_json['sources'] = self.sources
-        prov_store[key] = header_json
+        key = store_prov(header_json)
 
         probe, real_gen = itertools.tee(gen)
         try:
@@ -425,16 +596,45 @@ class Service(AbstractService):
         except StopIteration:
             pass
 
-        result = result_generator(real_gen, lambda: client.metadata)
-        response = Response(result, mimetype='application/json')
-        # store and add header for: client.metadata['prov']
-        response.headers['Link'] = ('{}; rel="http://www.w3.org/ns/prov'
-                                    '#has_provenance"').format(
-            api_url_for('prov',
-                        namespace=self.namespace,
-                        service=self.adapter_name,
-                        uuid=key))
-        return response
+        def stop():
+            cancel_worker(client)
+            client.close()
+
+        return (real_gen, lambda: getattr(client, 'metadata', {}), stop,
+                key)
+
+    def query_message(self, endpoint, args, req):
+        """Add to ``args`` the fields needed by a QueryWorker."""
+
+        args['_namespace'] = self.namespace
+        args['_adapter'] = self.adapter_name
+        args['_endpoint'] = endpoint
+        args['_headers'] = dict(req.headers)
+        args['_token'] = get_token(req.headers)
+        args['_url'] = (Config.get('server', 'api_url') +
+                        Config.get('server', 'api_prefix'))
+        args['_queue_host'] = Config.get('queue', 'host')
+        args['_queue_port'] = Config.getint('queue', 'port')
+        args['_store_host'] = Config.get('store', 'host')
+        args['_store_port'] = Config.getint('store', 'port')
+        args['_queue_name'] = self.iden
+        return args
+
+    def exec_batch(self, queries, req):
+        """Run many search ``queries`` through the QueryWorkers.
+
+        Return a response streaming the results as newline delimited
+        JSON.
+
+        :type queries: list[dict]
+        """
+        if self.type != 'query':
+            raise APIException('batches are only supported by adapters '
+                               'of type query', 400)
+        tick(self, req, endpoint='batch', args={'size': len(queries)})
+        return Response(
+            stream_with_context(batch_generator(self, queries, req)),
+            mimetype='application/x-ndjson')
 
     def exec_worker_map_filter(self, endpoint, args, req):
         """Forward request and process response.
@@ -443,46 +643,142 @@ class Service(AbstractService):
         response through the ``process`` user function.
 
         """
-        del args
         if endpoint != 'search':
             raise APIException("service of type 'map_filter' does "
                                "not support /list")
+        fmt = formats.negotiate(req)
+        page = Page(args)
+        results, metadata, stop, key = self.map_filter_results(
+            [(param, value) for param, value in req.args.items(multi=True)
+             if param not in RESERVED_PARAMS],
+            req)
+        response = self.results_response(
+            fmt, endpoint, page.paginate(results, stop),
+            lambda: dict(metadata(), **page.to_json()),
+            stop)
+        response.headers['Link'] = self.prov_link(key)
+        return response
 
-        if is_https(self.url) and req.method == 'GET':
-            method = tls1_get
-        else:
-            method = getattr(requests, req.method.lower())
+    def map_filter_results(self, params, req):
+        """Query the third party service and map its response.
+
+        ``params`` are the query parameters for the third party
+        service.  Return the same as ``query_results``.
+
+        """
         try:
             headers = {'Authorization': req.headers['Authorization']}
         except KeyError:
             headers = {}
-        response = method(self.url,
-                          params=req.args,
-                          headers=headers,
-                          stream=True)
-        if response.ok:
-            path = '.'.join(filter(None, [self.json_path, 'item']))
-            results = ijson.items(FileLikeWrapper(response), path)
-
-            headers = req.headers
-            response = Response(
-                result_generator(process_by_client(self, results, headers),
-                                 lambda: {}),
-                mimetype='application/json')
-
-            key = uuid.uuid4().hex
-            prov_store[key] = {'sources': self.sources}
-
-            response.headers['Link'] = ('{}; rel="http://www.w3.org/ns/prov'
-                                        '#has_provenance"').format(
-                api_url_for('prov',
-                            namespace=self.namespace,
-                            service=self.adapter_name,
-                            uuid=key))
-            return response
-        else:
+        response = sessions.request(
+            'GET', self.url,
+            tlsv1=is_https(self.url),
+            params=params,
+            headers=headers,
+            stream=True)
+        if not response.ok:
             raise APIException('response from external service: {}'
                                .format(response))
+        results = records(response, self.json_path,
+                          getattr(self, 'upstream_format', None))
+        metadata = {}
+        processed = process_by_client(self, results, req.headers, metadata)
+        return (processed, lambda: metadata, processed.close,
+                store_prov({'sources': self.sources}))
+
+    def results(self, endpoint, args, req):
+        """Results of ``endpoint`` with ``args``, as in ``query_results``.
+
+        ``args`` and the results are validated as in the requests to the
+        service (see ``validated_args`` and ``validated_results``).
+
+        :type args: dict
+        """
+        args = without_reserved(validated_args(self, endpoint, args))
+        if self.type == 'query':
+            results, metadata, stop, prov = self.query_results(
+                endpoint, args, req)
+        elif self.type == 'map_filter' and endpoint == 'search':
+            results, metadata, stop, prov = self.map_filter_results(
+                args.items(), req)
+        else:
+            raise APIException('service of type {!r} does not produce '
+                               'results for /{}'.format(self.type, endpoint),
+                               400)
+        return (self.validated_results(endpoint, results, stop),
+                metadata, stop, prov)
+
+    def validated_results(self, endpoint, results, cancel=None):
+        """Check ``results`` against the response schema of ``endpoint``.
+
+        Results are checked only if the service validates its
+        responses (see ``validation.validate``).
+
+        """
+        if self.validate_response:
+            validator = validation.validator_for(self, endpoint)
+            if validator is not None:
+                return validation.validate(
+                    results, validator, self.validate_response, endpoint,
+                    cancel)
+        return results
+
+    def prov_url(self, key):
+        """Url of the provenance ``key``."""
+
+        return api_url_for('prov',
+                           namespace=self.namespace,
+                           service=self.adapter_name,
+                           uuid=key)
+
+    def prov_link(self, key):
+        """Value of the ``Link`` header for the provenance ``key``."""
+
+        return ('{}; rel="http://www.w3.org/ns/prov'
+                '#has_provenance"').format(self.prov_url(key))
+
+    def results_response(self, fmt, endpoint, results, metadata,
+                         cancel=None):
+        """Return a response streaming ``results`` in the format ``fmt``.
+
+        Arguments are as in ``result_generator``.  If the service
+        validates its responses, ``results`` are checked against the
+        response schema of ``endpoint`` as they are streamed.
+
+        """
+        results = self.validated_results(endpoint, results, cancel)
+        if fmt == 'json':
+            body = formats.Stream(lambda stream: result_generator(
+                results, metadata, cancel, stream))
+        else:
+            columns = (self.response_columns(endpoint)
+                       if fmt in formats.DELIMITERS else None)
+            body = formats.Stream(lambda stream: formats.encode(
+                fmt, results, metadata, cancel, columns, stream))
+        response = Response(body, mimetype=formats.MIMETYPES[fmt])
+        response.headers['Vary'] = 'Accept'
+        return response
+
+    def response_columns(self, endpoint):
+        """Properties of the results declared in the docs of ``endpoint``.
+
+        :rtype: list[str]|None
+        """
+        schema = self.response_schema(endpoint) or {}
+        properties = schema.get('properties')
+        return sorted(properties) if properties else None
+
+    def response_schema(self, endpoint):
+        """Schema of each result declared in the docs of ``endpoint``.
+
+        :rtype: dict|None
+        """
+        md = fix_metadata({'type': self.type, 'endpoints': self.endpoints})
+        descr = md['endpoints'].get('/' + endpoint, {}).get('get', {})
+        schema = descr.get('response')
+        if not schema:
+            return None
+        return schema.get('items', schema)
 
     def exec_worker_generic(self, endpoint, args, req):
         queue = self.iden
@@ -503,31 +799,33 @@ class Service(AbstractService):
                           queue_port=Config.getint('queue', 'port'),
                           queue_name=queue)
         client.send(args)
-        result = client.receive(max_wait=self.timeout)
-        header = next(result)
-        print('header', header)
-        response = list(result)
-        if len(response) != 1:
-            raise APIException(
-                'Wrong return type of generic adapter: got {} results'
-                .format(len(response)))
-        response = response[0]
-        if 'error' not in response:
-            resp = Response(base64.b64decode(response['body']),
-                            content_type=response['content_type'])
+        messages = client.receive_chunks(max_wait=self.timeout)
+        header = next(messages)
+        if 'content_type' in header:
+            resp = Response(binary_body(client, messages),
+                            content_type=header['content_type'],
+                            direct_passthrough=True)
         else:
-            resp = Response(json.dumps(response),
-                            content_type='application/json')
-
-        key = uuid.uuid4().hex
-        prov_store[key] = {'sources': self.sources}
+            # an error, or a worker sending the whole body in base64
+            response = list(messages)
+            if len(response) != 1:
+                raise APIException(
+                    'Wrong return type of generic adapter: got {} results'
+                    .format(len(response)))
+            response = response[0]
+            if 'error' not in response:
+                resp = Response(base64.b64decode(response['body']),
+                                content_type=response['content_type'])
+            else:
+                resp = Response(json.dumps(response),
+                                content_type='application/json')
+                resp.cacheable = False
 
-        resp.headers['Link'] = ('{}; rel="http://www.w3.org/ns/prov'
-                                '#has_provenance"').format(
-            api_url_for('prov',
-                        namespace=self.namespace,
-                        service=self.adapter_name,
-                        uuid=key))
+        # the header may carry provenance sent by the adapter
+        prov = {field: value for field, value in header.items()
+                if field != 'content_type'}
+        prov['sources'] = self.sources
+        resp.headers['Link'] = self.prov_link(store_prov(prov))
 
         return resp
 
@@ -537,28 +835,33 @@ class Service(AbstractService):
         ``endpoint`` is what comes after the /access endpoint, and it
         should be added to the final url.
 
+        Both the body of the request and the body of the response are
+        streamed, so large uploads and downloads never sit in memory.
+
         """
         del args
-        method = getattr(requests, req.method.lower())
-        data = req.data if req.data else req.form
         url = _join(self.url, endpoint)
         headers = dict(self.filter_headers(url, req))
-        response = method(url, params=req.args, data=data, headers=headers,
-                          stream=True)
+        for header in RANGE_HEADERS:
+            if header in req.headers:
+                headers[header] = req.headers[header]
+        data = None
+        if req.content_length:
+            data = RequestBody(req.stream, req.content_length)
+            if 'Content-Type' in req.headers:
+                headers['Content-Type'] = req.headers['Content-Type']
+        response = sessions.request(req.method, url, params=req.args,
+                                    data=data, headers=headers, stream=True)
         resp = Response(
-            response=response.raw.read(),
+            response=stream_body(response),
             status=response.status_code,
-            headers=response.headers.items())
-
-        key = uuid.uuid4().hex
-        prov_store[key] = {'sources': self.sources}
+            headers=[(header, value)
+                     for header, value in response.headers.items()
+                     if header.lower() not in HOP_BY_HOP_HEADERS],
+            direct_passthrough=True)
 
-        resp.headers['Link'] = ('{}; rel="http://www.w3.org/ns/prov'
-                                '#has_provenance"').format(
-            api_url_for('prov',
-                        namespace=self.namespace,
-                        service=self.adapter_name,
-                        uuid=key))
+        resp.headers['Link'] = self.prov_link(
+            store_prov({'sources': self.sources}))
 
         return resp
 
@@ -583,6 +886,11 @@ class ServiceQueryResource(restful.Resource):
             <p>The parameters and response type of this operation are
             dependent on the particular service.</p>
 
+            <p>The results can be paginated with the parameters
+            <code>_limit</code> and <code>_offset</code>, or
+            <code>_cursor</code> (the <code>next_cursor</code> in the
+            metadata of the previous page).</p>
+
             """),
         nickname='search'
     )
@@ -614,7 +922,9 @@ class ServiceListResource(restful.Resource):
             service.
 
             <p>This query takes no parameters other than pagination
-            specific parameters. It returns a list of objects.</p>
+            specific parameters (<code>_limit</code>,
+            <code>_offset</code> and <code>_cursor</code>). It returns a
+            list of objects.</p>
 
             """),
         nickname='list'
@@ -637,6 +947,45 @@ class ServiceListResource(restful.Resource):
         return {key: val[0] for key, val in dict(request.args).items()}
 
 
+class ServiceBatchResource(restful.Resource):
+
+    @swagger.operation(
+        notes=textwrap.dedent(
+            """Perform many search queries using the adapter registered
+            for this service.
+
+            <p>The body is a JSON array of objects, each one with the
+            parameters of a search query.  The queries are executed
+            concurrently, and the results are returned as newline
+            delimited JSON.  Each line is an object with the field
+            <code>index</code> (the position of the query in the
+            array) and either <code>result</code> (a result of the
+            query) or <code>status</code> (the end of the query).  An
+            error in a query doesn't stop the other ones.</p>
+
+            <p>Only supported by adapters of type <code>query</code>.</p>
+
+            """),
+        nickname='batch'
+    )
+    def post(self, namespace, service):
+        """Perform a batch of queries using a service"""
+
+        queries = self.validate_post()
+        srv = get_service(namespace, service)
+        return srv.exec_batch(queries, request)
+
+    def validate_post(self):
+        queries = request.get_json(force=True, silent=True)
+        if (not isinstance(queries, list) or
+                not all(isinstance(query, dict) for query in queries)):
+            raise APIException('body must be a JSON array of objects', 400)
+        if len(queries) > BATCH_MAX_SIZE:
+            raise APIException('too many queries in the batch (maximum {})'
+                               .format(BATCH_MAX_SIZE), 400)
+        return queries
+
+
 @swagger.model
 class ServiceModel(object):
 
@@ -781,7 +1130,14 @@ class ServiceResource(restful.Resource):
             except Exception:
                 # ignore any error while stopping and removing workers
                 pass
+            if (service_store[name]['slot'] == 'busy' or
+                    is_updating(service_store[name])):
+                jobs.cancel(namespace, name)
             del service_store[name]
+            response_cache.invalidate(name)
+            forget_adapter_cache(name)
+            forget_swagger_app(name)
+            validation.forget(name)
         except KeyError:
             pass
         return ok({})
@@ -919,24 +1275,21 @@ class ServiceResource(restful.Resource):
             raise APIException('service not found: {}'.format(name), 404)
 
         old_srv = slot['service']
+        if old_srv is None:
+            raise APIException('service not ready: {}'.format(name), 400)
         if 'PUT' not in get_permissions(old_srv.users, g.user):
             raise APIException(
                 'user {} does not have permissions to PUT to '
                 'service {}'.format(g.user, name))
 
         args = self.validate_put()
-        if old_srv is None:
-            raise APIException('service not ready: {}'.format(name), 400)
-        old_srv.stop_workers()
-        slot['slot'] = 'free'
-        slot['service'] = None
-        service_store[name] = slot
         # if args.update, then update the git repo
         if args.get('update_git_repository', False):
             with chdir(old_srv.code_dir):
                 subprocess.check_call('git pull'.split())
-        register(
-            Service, args, namespace, old_srv.code_dir, post_notifier)
+        update(old_srv, args, post_notifier)
+        forget_swagger_app(name)
+        validation.forget(name)
         return ok({})
 
     @staticmethod
@@ -963,13 +1316,73 @@ class ServiceResource(restful.Resource):
         return args
 
 
-class ServiceHealthResource(restful.Resource):
+class ServiceRegistrationResource(restful.Resource):
 
-    @staticmethod
-    def _is_running(worker):
-        running = docker_output(
-            'inspect', '-f', '{{.State.Running}}', worker).strip()
-        return running == 'true'
+    @swagger.operation(
+        notes=textwrap.dedent(
+            """Follow the registration of a service.
+
+            <p>Return a stream of Server-Sent Events, one for each
+            change of the state of the registration (the same state
+            returned by <code>GET /{namespace}/{service}</code>).  The
+            event is <code>busy</code> while the registration is in
+            progress, and the stream ends with a <code>ready</code> or
+            <code>error</code> event.  Long registrations are followed
+            through several streams: a stream lasts at most a few
+            minutes, and clients reconnect (as
+            <code>EventSource</code> does) to get the current state and
+            the next events.</p>
+
+            """),
+        nickname='followRegistration'
+    )
+    def get(self, namespace, service):
+        """Follow the registration of a service"""
+
+        name = service_iden(namespace, service)
+        if name not in service_store:
+            raise APIException('service not found: {}'.format(name), 404)
+
+        def current():
+            try:
+                return slot_state(service_store[name])
+            except KeyError:
+                return None
+
+        response = Response(jobs.events(name, current),
+                            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    @swagger.operation(
+        notes="Cancel the registration of a service, while it's queued "
+              "or in between its stages.",
+        nickname='cancelRegistration'
+    )
+    def delete(self, namespace, service):
+        """Cancel the registration of a service"""
+
+        name = service_iden(namespace, service)
+        try:
+            slot = service_store[name]
+        except KeyError:
+            raise APIException('service not found: {}'.format(name), 404)
+        ns = namespace_store[namespace]
+        if 'POST' not in get_permissions(ns.users, g.user):
+            raise APIException(
+                'user {} does not have permissions to POST to '
+                'namespace {}'.format(g.user, namespace))
+        if slot['slot'] != 'busy':
+            raise APIException('service is not being registered: {}'
+                               .format(name), 400)
+        if jobs.cancel(namespace, name):
+            slot['msg'] = 'Error: registration cancelled'
+            slot['slot'] = 'error'
+            save_slot(name, slot)
+        return ok({})
+
+
+class ServiceHealthResource(restful.Resource):
 
     def get(self, namespace, service):
         name = service_iden(namespace, service)
@@ -978,8 +1391,7 @@ class ServiceHealthResource(restful.Resource):
         except KeyError:
             raise APIException('service not found: {}'.format(name), 404)
         srv = slot['service']
-        workers_alive = len([worker for worker in srv.workers
-                             if self._is_running(worker)])
+        workers_alive = len(filter(is_up, srv.workers))
         should_have = int(request.args.get('workers', 1))
         app.logger.debug(str(srv.workers))
         app.logger.debug('workers = {}'.format(workers_alive))
@@ -1021,17 +1433,6 @@ class StatsResource(restful.Resource):
         })
 
 
-class FileLikeWrapper(object):
-
-    def __init__(self, response):
-        self.response = response
-        self.it = self.response.iter_content(chunk_size=1)
-        self.src = itertools.chain.from_iterable(self.it)
-
-    def read(self, n=512):
-        return ''.join(itertools.islice(self.src, 0, n))
-
-
 def normalize_case(obj):
     """Convert keys and values to lowercase, recursively. """
 
@@ -1044,38 +1445,244 @@ def normalize_case(obj):
     return obj
 
 
-def process_by_client(service, results, headers):
-    """Process results through a ProcessWorker.
+def process_by_client(service, results, headers, metadata=None):
+    """Process results through the ProcessWorkers of ``service``.
+
+    Records are grouped in batches of ``MAP_FILTER_BATCH_SIZE`` and each
+    batch is sent as one message tagged with its sequence number, so all
+    the workers of the service consume batches concurrently.  At most
+    ``MAP_FILTER_BATCHES_PER_WORKER`` batches per worker are in flight at
+    any time, and their results are produced in the original order.
+
+    Workers that don't take batches (see ``accepts_batches``) get one
+    record per message, with the same window.
+
+    The END metadata of all the batches is accumulated into the
+    dictionary ``metadata``, if given.  The batches still in flight when
+    the generator is closed are cancelled.
 
     Return a generator which produces JSON objects (as strings).
 
     """
+    common = {
+        '_headers': dict(headers),
+        '_token': get_token(headers),
+        '_url': (Config.get('server', 'api_url') +
+                 Config.get('server', 'api_prefix')),
+        '_queue_host': Config.get('queue', 'host'),
+        '_queue_port': Config.getint('queue', 'port'),
+        '_store_host': Config.get('store', 'host'),
+        '_store_port': Config.getint('store', 'port')
+    }
+    window = max(1, len(service.workers)) * MAP_FILTER_BATCHES_PER_WORKER
+    if accepts_batches(service):
+        messages = (dict(common, _batch=batch, _seq=seq)
+                    for seq, batch in enumerate(
+                        chunks(results, MAP_FILTER_BATCH_SIZE)))
+    else:
+        messages = (dict(record, **common) for record in results)
+    messages = enumerate(messages)
+    in_flight = collections.deque()
+    idle = []
+    # client of the batch being produced
+    current = None
+    try:
+        while True:
+            for seq, message in itertools.islice(
+                    messages, window - len(in_flight)):
+                client = idle.pop() if idle else Producer(
+                    queue_host=common['_queue_host'],
+                    queue_port=common['_queue_port'],
+                    queue_name=service.iden)
+                client.send(message)
+                in_flight.append((seq, client))
+            if not in_flight:
+                return
+            seq, current = in_flight.popleft()
+            client = current
+            response = client.receive(max_wait=service.timeout)
+            next(response)  # header
+            for obj in response:
+                yield json.dumps(obj)
+                if 'error' in obj:
+                    # abort as soon as there is an error
+                    return
+            # workers answering single records don't report it
+            if client.metadata.get('seq') not in (None, seq):
+                raise APIException(
+                    'batch {} answered out of order (got {})'
+                    .format(seq, client.metadata['seq']))
+            if metadata is not None:
+                merge_metadata(metadata, client.metadata)
+            idle.append(client)
+            current = None
+    finally:
+        busy = [client for _, client in in_flight]
+        if current is not None:
+            busy.append(current)
+        for client in busy:
+            cancel_worker(client)
+        for client in itertools.chain(busy, idle):
+            client.close()
+
+
+def accepts_batches(service):
+    """Whether all the workers of ``service`` take batches of records.
+
+    Workers report the version of their protocol in their heartbeats.
+    The ones that don't (images built before batches, and the workers
+    of other languages) take one record per message.
+
+    """
+    beats = [last_heartbeat(worker) for worker in service.workers]
+    return bool(beats) and all(
+        beat is not None and beat.get('protocol', 1) >= BATCH_PROTOCOL
+        for beat in beats)
+
+
+# What ``validate_swagger_request`` needs from a request
+BatchQuery = collections.namedtuple('BatchQuery', ['method', 'args'])
+
+
+def batch_generator(service, queries, req):
+    """Execute ``queries`` in the QueryWorkers of ``service``.
+
+    Like ``process_by_client``, at most ``BATCH_QUERIES_PER_WORKER``
+    queries per worker are in flight at any time.  Produce a line of
+    JSON for each result, tagged with the index of its query, and a
+    final line with the status of each query.
 
-    client = Producer(
-        queue_host=Config.get('queue', 'host'),
-        queue_port=Config.getint('queue', 'port'),
-        queue_name=service.iden)
-    for result in results:
-        result['_headers'] = dict(headers)
-        result['_token'] = get_token(headers)
-        result['_url'] = (Config.get('server', 'api_url') +
-                          Config.get('server', 'api_prefix'))
-        result['_queue_host'] = Config.get('queue', 'host')
-        result['_queue_port'] = Config.getint('queue', 'port')
-        result['_store_host'] = Config.get('store', 'host')
-        result['_store_port'] = Config.getint('store', 'port')
-        client.send(result)
-        response = client.receive(max_wait=service.timeout)
-        header = next(response)
-        print('header', header)
-        for obj in response:
-            yield json.dumps(obj)
-            if 'error' in obj:
-                # abort as soon as there is an error
+    """
+    window = max(1, len(service.workers)) * BATCH_QUERIES_PER_WORKER
+    pending = enumerate(queries)
+    in_flight = collections.deque()
+    idle = []
+    # client of the query being produced
+    current = None
+    try:
+        while True:
+            for index, query in itertools.islice(
+                    pending, window - len(in_flight)):
+                try:
+                    message = batch_message(service, query, req)
+                    client = idle.pop() if idle else Producer(
+                        queue_host=Config.get('queue', 'host'),
+                        queue_port=Config.getint('queue', 'port'),
+                        queue_name=service.iden)
+                    client.send(message)
+                    in_flight.append((index, client))
+                except Exception as exc:
+                    yield batch_line(index, status='error', error=str(exc))
+            if not in_flight:
                 return
+            index, current = in_flight.popleft()
+            client = current
+            try:
+                for line in batch_results(service, index, client):
+                    yield line
+                idle.append(client)
+            except Exception as exc:
+                current = None
+                cancel_worker(client)
+                client.close()
+                yield batch_line(index, status='error', error=str(exc))
+            current = None
+    finally:
+        busy = [client for _, client in in_flight]
+        if current is not None:
+            busy.append(current)
+        for client in busy:
+            cancel_worker(client)
+        for client in itertools.chain(busy, idle):
+            client.close()
+
+
+def batch_message(service, query, req):
+    """Build the message for the QueryWorker from a ``query`` of a batch."""
+
+    return service.query_message(
+        'search', validated_args(service, 'search', query), req)
+
+
+def validated_args(service, endpoint, query):
+    """Arguments ``query`` for ``endpoint``, validated if ``service`` asks.
+
+    ``query`` is a dictionary of values, or lists of values, as in the
+    JSON bodies of batches and federated queries.
+
+    :type query: dict
+    :rtype: dict
+    """
+    args = dict(query)
+    if service.validate_request:
+        params = MultiDict(
+            (key, value)
+            for key, values in query.items()
+            for value in (values if isinstance(values, list) else [values]))
+        args.update(validate_swagger_request(
+            service, endpoint, BatchQuery('GET', params)))
+    return args
+
+
+def batch_results(service, index, client):
+    """Produce the lines for the results of the query ``index``."""
+
+    response = client.receive(max_wait=service.timeout)
+    header = next(response)
+    header['sources'] = service.sources
+    key = store_prov(header)
+    error = None
+    for obj in response:
+        if 'error' in obj and 'traceback' in obj:
+            error = obj['error']
+        else:
+            yield batch_line(index, result=obj)
+    fields = {'error': error} if error is not None else {}
+    yield batch_line(
+        index, status='error' if error is not None else 'success',
+        prov=service.prov_url(key),
+        metadata={
+            'time_in_main': client.metadata.get('time_in_main'),
+            'cache': client.metadata.get('cache'),
+            'telemetry': client.metadata.get('telemetry')
+        }, **fields)
+
 
+def batch_line(index, **fields):
+    return json.dumps(dict(fields, index=index)) + '\n'
 
-def result_generator(results, metadata):
+
+def merge_metadata(total, md):
+    """Accumulate the END metadata ``md`` of a worker into ``total``.
+
+    Counters and times are added up, while the memory growth keeps the
+    maximum over all the workers.
+
+    """
+    for field in ('cache', 'telemetry'):
+        values = md.get(field) or {}
+        acc = total.setdefault(field, {})
+        for key, value in values.items():
+            if value is None:
+                continue
+            if key == 'rss_delta':
+                acc[key] = max(acc.get(key, value), value)
+            else:
+                acc[key] = acc.get(key, 0) + value
+
+
+def cancel_worker(client):
+    """Tell the worker answering ``client`` to stop producing results."""
+
+    try:
+        client.cancel(Config.get('store', 'host'),
+                      Config.getint('store', 'port'))
+    except Exception:
+        # the worker just runs until the end
+        pass
+
+
+def result_generator(results, metadata, cancel=None, stream=None):
     """Construct JSON response from ``results``.
 
     ``results`` is a generator that produces JSON objects, and
@@ -1085,19 +1692,29 @@ def result_generator(results, metadata):
     information after the ``results`` generator has been exhausted
     (for example: timing).
 
+    ``cancel`` is called if the response is closed (the client went
+    away) before consuming all the results.  ``stream`` (a
+    ``formats.Stream``) is marked as failed on errors.
+
     """
+    exhausted = False
     try:
         yield '{"result": [\n'
         for line in interleave(['\n, '], results):
             yield line
+        exhausted = True
         yield '\n],\n'
-        md = metadata()
-        yield '"metadata": {0},\n'.format(json.dumps({
-            'time_in_main': md.get('time_in_main', None)
-        }))
+        yield '"metadata": {0},\n'.format(
+            json.dumps(formats.metadata_fields(metadata())))
         yield '"status": "success"}\n'
+    except GeneratorExit:
+        if not exhausted and cancel is not None:
+            cancel()
+        raise
     except Exception:
         exc = traceback.format_exc()
+        if stream is not None:
+            stream.failed = True
         yield '---\n'
         yield exc
 
@@ -1106,24 +1723,6 @@ def is_https(url):
     return urlparse.urlparse(url).scheme == 'https'
 
 
-class TLSv1Adapter(requests.adapters.HTTPAdapter):
-    """Adapter to support TLSv1 in requests."""
-
-    def init_poolmanager(self, connections, maxsize, block=False):
-        self.poolmanager = requests.packages.urllib3.poolmanager.PoolManager(
-            num_pools=connections,
-            maxsize=maxsize,
-            block=block,
-            ssl_version=ssl.PROTOCOL_TLSv1)
-
-
-def tls1_get(*args, **kwargs):
-    session = requests.Session()
-    session.mount('https://', TLSv1Adapter())
-    kwargs['verify'] = False
-    return session.get(*args, **kwargs)
-
-
 def check(producer):
     """Check status of a container.
 
@@ -1139,30 +1738,156 @@ def check(producer):
     return state
 
 
+def watch_workers(workers, timeout, logs=None, ready=WORKER_STARTED):
+    """Return the state each of the ``workers`` reports at start up.
+
+    Return as soon as any worker reports an error or, shortly after
+    (``STARTED_GRACE``), all of them report they started (the line
+    ``ready``).  The state of a worker that reports nothing within
+    ``timeout`` seconds is None.
+
+    ``logs`` maps the workers to the ``docker.Logs`` to follow, by
+    default all their logs.  All of them are closed on return, and the
+    threads following them are finished.
+
+    :type workers: list[str]
+    :type logs: dict[str, adama.docker.Logs]
+    :type ready: str
+    :rtype: dict[str, WorkerState|None]
+    """
+    events = Queue.Queue()
+    stop = threading.Event()
+    logs = dict(logs or {})
+    threads = []
+    try:
+        for worker in workers:
+            if worker not in logs:
+                try:
+                    logs[worker] = Logs(worker)
+                except Exception:
+                    events.put((worker, WorkerState.error))
+                    continue
+            thread = threading.Thread(target=watch_worker,
+                                      args=(worker, logs[worker], events,
+                                            stop, ready),
+                                      name='Worker log {}'.format(worker))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        states = dict.fromkeys(workers)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                worker, state = events.get(
+                    timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                return states
+            states[worker] = state
+            if state == WorkerState.error:
+                return states
+            if all(states.values()):
+                deadline = min(deadline, time.time() + STARTED_GRACE)
+    finally:
+        stop.set()
+        for stream in logs.values():
+            stream.close()
+        for thread in threads:
+            thread.join(STOP_TIMEOUT)
+
+
+def watch_worker(worker, logs, events, stop, ready=WORKER_STARTED):
+    """Put in ``events`` the states reported in the ``logs`` of ``worker``.
+
+    The end of the logs (the container stopped) counts as an error,
+    unless the watch was stopped by setting ``stop``.
+
+    """
+    try:
+        for line in logs:
+            if stop.is_set():
+                return
+            if line.startswith('*** WORKER ERROR'):
+                break
+            if line.startswith(ready):
+                events.put((worker, WorkerState.started))
+    except Exception:
+        pass
+    if not stop.is_set():
+        events.put((worker, WorkerState.error))
+
+
 def render_template(main_module_path, main_module_name,
-                    language, requirements, into):
-    """Create Dockerfile for ``language``.
+                    base_image, into):
+    """Create Dockerfile for an adapter on top of ``base_image``.
 
-    Consider a list of ``requirements``, and write the Dockerfile in
-    directory ``into``.
+    Write the Dockerfile in directory ``into``.
 
     """
 
     dockerfile_template = jinja2.Template(
         open(os.path.join(HERE, 'containers/Dockerfile.adapter')).read())
-    requirement_cmds = (
-        'RUN ' + requirements_installer(language, requirements)
-        if requirements else '')
-
     dockerfile = dockerfile_template.render(
         main_module_path=main_module_path,
         main_module_name=main_module_name,
-        language=language,
-        requirement_cmds=requirement_cmds)
+        base_image=base_image)
     with open(os.path.join(into, 'Dockerfile'), 'w') as f:
         f.write(dockerfile)
 
 
+def requirements_image(language, requirements):
+    """Return the base image for ``language`` with ``requirements``.
+
+    Adapters with the same set of requirements share the same base
+    image, which is built only the first time it's needed (and again
+    if the image of ``language`` changes).
+
+    """
+    if not requirements:
+        return language
+    requirements = sorted(set(requirements))
+    digest = hashlib.sha1(json.dumps(
+        [language, image_id(language), requirements])).hexdigest()
+    image = 'adama-requirements-{}:{}'.format(
+        language, digest[:IMAGE_HASH_LENGTH])
+    if image_exists(image):
+        return image
+    tempdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tempdir, 'Dockerfile'), 'w') as f:
+            f.write('FROM {}\nRUN {}\n'.format(
+                language, requirements_installer(language, requirements)))
+        build_image(tempdir, image)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+    return image
+
+
+def content_hash(directory, base_id=None):
+    """Hash of the names, modes and contents of the files in ``directory``.
+
+    ``base_id`` is the id of the base image, so images are rebuilt when
+    their base changes.
+
+    :type base_id: str|None
+    :rtype: str
+    """
+    digest = hashlib.sha1('{}\0'.format(base_id or ''))
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                data = os.readlink(path)
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            digest.update('{}\0{:o}\0{}\0'.format(
+                os.path.relpath(path, directory),
+                os.lstat(path).st_mode & 0o777, len(data)))
+            digest.update(data)
+    return digest.hexdigest()[:IMAGE_HASH_LENGTH]
+
+
 def requirements_installer(language, requirements):
     """Return the command to install requirements.
 
@@ -1226,6 +1951,183 @@ def _join(url, endpoint):
     return urlparse.urlunsplit(parts)
 
 
+class RequestBody(object):
+    """Body of an incoming request, to be streamed to a third party.
+
+    Knowing the length lets ``requests`` send a ``Content-Length``
+    header instead of a chunked body.
+
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, n=-1):
+        return self.stream.read(n)
+
+    def __iter__(self):
+        while True:
+            chunk = self.stream.read(PASSTHROUGH_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def without_reserved(args):
+    """Remove from ``args`` the parameters interpreted by Adama.
+
+    :type args: dict
+    :rtype: dict
+    """
+    for param in RESERVED_PARAMS:
+        args.pop(param, None)
+    return args
+
+
+def drain(results, cancel):
+    """Read the rest of ``results``, so their metadata arrives.
+
+    If more than ``PAGE_DRAIN`` results are left (or reading them
+    fails), ``cancel`` them instead.
+
+    """
+    try:
+        left = sum(1 for _ in itertools.islice(results, PAGE_DRAIN + 1))
+    except Exception:
+        left = None
+    if left is None or left > PAGE_DRAIN:
+        cancel()
+
+
+class Page(object):
+    """A page of the results of a query.
+
+    The page is selected with the query parameters ``_limit`` and
+    ``_offset``, or with ``_cursor`` (as returned in the ``next_cursor``
+    field of the metadata of the previous page).  The parameters are
+    removed from ``args``.
+
+    """
+
+    def __init__(self, args):
+        params = {param: args.pop(param, None) for param in PAGE_PARAMS}
+        offset = params['_offset']
+        if params['_cursor'] is not None:
+            offset = self.decode_cursor(params['_cursor'])
+        self.offset = self.to_int('_offset', offset or 0, 0)
+        self.limit = (self.to_int('_limit', params['_limit'], 1)
+                      if params['_limit'] is not None else None)
+        self.next_cursor = None
+
+    @staticmethod
+    def to_int(name, value, minimum):
+        try:
+            value = int(value)
+            if value < minimum:
+                raise ValueError
+            return value
+        except (TypeError, ValueError):
+            raise APIException('{} must be an integer >= {}'
+                               .format(name, minimum), 400)
+
+    @staticmethod
+    def encode_cursor(offset):
+        return base64.urlsafe_b64encode(json.dumps({'offset': offset}))
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            return json.loads(base64.urlsafe_b64decode(str(cursor)))['offset']
+        except (TypeError, ValueError, KeyError):
+            raise APIException('invalid cursor: {}'.format(cursor), 400)
+
+    @property
+    def needed(self):
+        """Number of records to read, or None for all of them.
+
+        One record past the page tells whether there is a next page.
+
+        """
+        if self.limit is None:
+            return None
+        return self.offset + self.limit + 1
+
+    def paginate(self, results, cancel):
+        """Produce the records of ``results`` in this page.
+
+        Call ``cancel`` once no more records are needed.
+
+        """
+        for i, record in enumerate(results):
+            if i < self.offset:
+                continue
+            if self.limit is not None and i >= self.offset + self.limit:
+                self.next_cursor = self.encode_cursor(i)
+                cancel()
+                return
+            yield record
+
+    def to_json(self):
+        if self.limit is None:
+            return {}
+        return {'next_cursor': self.next_cursor}
+
+
+def store_prov(obj):
+    """Store the provenance ``obj`` and return its key.
+
+    The key is a hash of the content, so identical provenance (for
+    example, the sources of a service, which are the same for all its
+    responses) is stored only once: keys already in the store are not
+    written again.
+
+    """
+    key = hashlib.sha1(json.dumps(obj, sort_keys=True)).hexdigest()
+    prov_store.setnx(key, obj)
+    return key
+
+
+def binary_body(client, chunks):
+    """Produce the binary ``chunks`` sent by a GenericWorker.
+
+    An error in the middle of the body aborts the response.  The worker
+    is cancelled if the body is not consumed to the end.
+
+    """
+    finished = False
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, dict):
+                raise APIException('generic adapter failed: {}'.format(
+                    chunk.get('error', chunk)))
+            yield chunk
+        finished = True
+    finally:
+        if not finished:
+            cancel_worker(client)
+            client.close()
+
+
+def stream_body(response):
+    """Produce the raw body of the third party ``response`` in chunks.
+
+    The body is not decoded, so its ``Content-Length`` and
+    ``Content-Encoding`` headers can be forwarded as they are.  The next
+    chunk is read only when the previous one was sent to the client.
+
+    """
+    try:
+        for chunk in response.raw.stream(PASSTHROUGH_CHUNK_SIZE,
+                                         decode_content=False):
+            yield chunk
+    finally:
+        response.close()
+
+
 def register_code(args, namespace, notifier=None):
     """Register code that comes in the POST request."""
 
@@ -1283,24 +2185,47 @@ def register(service_class, args, namespace, user_code, notifier=None):
 
     service_store[service.iden] = {
         'slot': 'busy',
-        'msg': 'Empty service created',
+        'msg': 'Queued for registration',
         'stage': 1,
         'total_stages': 6,
         'service': None
     }
 
     service.registration_timestamp = datetime.datetime.now().isoformat(' ')
-    _async_register(service, notifier)
+    try:
+        _async_register(service, notifier)
+    except Exception:
+        del service_store[service.iden]
+        raise
     return service
 
 
 def _async_register(service, notifier):
-    """Launch async process for actual registration."""
+    """Queue the actual registration (see ``jobs``)."""
+
+    jobs.submit(service.namespace, service.iden,
+                _register, service, notifier)
+
+
+def save_slot(full_name, slot):
+    """Save the registration ``slot`` and publish its new state."""
+
+    service_store[full_name] = slot
+    jobs.publish(full_name, slot_state(slot))
 
-    proc = multiprocessing.Process(
-        name='Async Registration {}'.format(service.iden),
-        target=_register, args=(service, notifier))
-    proc.start()
+
+def slot_state(slot):
+    """State of a registration ``slot``, as shown to the clients.
+
+    :type slot: dict|None
+    :rtype: dict|None
+    """
+    if slot is None:
+        return None
+    state = {key: value for key, value in slot.items() if key != 'service'}
+    if slot.get('service') is not None:
+        state['service'] = slot['service'].to_json()
+    return state
 
 
 def _register(service, notifier=None):
@@ -1308,43 +2233,198 @@ def _register(service, notifier=None):
 
     full_name = service.iden
     slot = service_store[full_name]
-    try:
-        slot['msg'] = 'Async image creation started'
-        slot['stage'] = 2
-        service_store[full_name] = slot
 
-        service.make_image()
+    def progress(msg, stage=None, check=True):
+        if check:
+            jobs.check_cancelled(full_name)
+        slot['msg'] = msg
+        if stage is not None:
+            slot['stage'] = stage
+        save_slot(full_name, slot)
 
-        slot['msg'] = 'Image for service created'
-        slot['stage'] = 3
-        service_store[full_name] = slot
+    try:
+        progress('Waiting to build the image', 2)
+        with jobs.stage(full_name, 'build'):
+            progress('Async image creation started')
+            service.make_image()
 
-        service.start_workers()
+        progress('Image for service created', 3)
+        with jobs.stage(full_name, 'start'):
+            service.start_workers(
+                progress=lambda started, total: progress(
+                    'Starting workers ({} of {} started)'
+                    .format(started, total), check=False))
 
-        slot['msg'] = 'Workers started'
-        slot['stage'] = 4
-        service_store[full_name] = slot
+            progress('Workers started', 4)
 
-        service.process_icon()
+            service.process_icon()
 
-        slot['msg'] = 'Icon processed'
-        slot['stage'] = 5
-        service_store[full_name] = slot
+            progress('Icon processed', 5)
 
-        service.check_health()
+            service.check_health()
 
         slot['msg'] = 'Service ready'
         slot['stage'] = 6
         slot['slot'] = 'ready'
         slot['service'] = service
-        service_store[full_name] = slot
+        save_slot(full_name, slot)
 
         result = ok
         data = service
     except Exception as exc:
+        if isinstance(exc, jobs.JobCancelled):
+            service.stop_workers()
         slot['msg'] = 'Error: {}'.format(exc)
         slot['slot'] = 'error'
+        # a cancelled registration may have been deleted already
+        if full_name in service_store:
+            save_slot(full_name, slot)
+
+        result = error
+        data = str(exc)
+
+    if service.notify and notifier is not None:
+        notifier(service.notify, result, data)
+
+
+def update(old_service, args, notifier=None):
+    """Replace a running service without interrupting it.
+
+    The old service keeps answering requests until the new one is
+    ready.  If only the code changed (same type, language, main module,
+    requirements and whitelist), the code is reloaded in place in the
+    running workers.  Otherwise, or if any worker fails to reload, new
+    workers are started from a new image and the old ones are drained
+    once the new ones are healthy.
+
+    """
+    full_name = old_service.iden
+    slot = service_store[full_name]
+    if is_updating(slot):
+        raise APIException('service is already being updated: {}'
+                           .format(full_name), 400)
+    service = Service(
+        namespace=old_service.namespace, code_dir=old_service.code_dir,
+        users=old_service.users, **dict(args))
+    if service.iden != full_name:
+        raise APIException('cannot change the name or version of '
+                           'service {}'.format(full_name), 400)
+    service.registration_timestamp = datetime.datetime.now().isoformat(' ')
+
+    slot['updating'] = True
+    slot['updating_since'] = time.time()
+    slot['msg'] = 'Queued for update'
+    service_store[full_name] = slot
+    try:
+        jobs.submit(old_service.namespace, full_name,
+                    _update, old_service, service, notifier)
+    except Exception:
+        slot['updating'] = False
+        slot['msg'] = 'Service ready'
         service_store[full_name] = slot
+        raise
+    return service
+
+
+def is_updating(slot):
+    """True if the service in ``slot`` is being updated.
+
+    The flag expires after ``UPDATE_TIMEOUT`` seconds, in case the job
+    updating the service died without clearing it.
+
+    """
+    return (slot.get('updating', False) and
+            time.time() - slot.get('updating_since', 0) < UPDATE_TIMEOUT)
+
+
+def forget_adapter_cache(iden):
+    """Remove the values cached by the adapter ``iden``.
+
+    See ``Cache`` in ``adamalib``, which keys them as
+    ``cache:<service>:<key>``.
+
+    """
+    try:
+        adapter_cache_store.delete_prefix('cache:{}:'.format(iden))
+    except redis.RedisError:
+        pass
+
+
+def reloadable(old_service, new_service):
+    """True if ``new_service`` can reuse the workers of ``old_service``."""
+
+    return all(getattr(old_service, field) == getattr(new_service, field)
+               for field in ('type', 'language', 'main_module_path',
+                             'requirements', 'whitelist'))
+
+
+def _update(old_service, service, notifier=None):
+    """Update a service (see ``update``)."""
+
+    full_name = service.iden
+
+    def progress(msg, **fields):
+        try:
+            slot = service_store[full_name]
+        except KeyError:
+            # deleted meanwhile
+            return
+        slot['msg'] = msg
+        slot.update(fields)
+        save_slot(full_name, slot)
+
+    swapped = False
+    try:
+        service.process_icon()
+        reloaded = False
+        if reloadable(old_service, service):
+            progress('Reloading code in running workers')
+            service.workers = old_service.workers
+            try:
+                service.reload_workers()
+                reloaded = True
+            except Exception as exc:
+                app.logger.warning('reload of {} failed, rebuilding: {}'
+                                   .format(full_name, exc))
+                service.workers = []
+        if reloaded:
+            progress('Code reloaded', service=service)
+            swapped = True
+            response_cache.invalidate(full_name)
+            forget_adapter_cache(full_name)
+            # new workers (e.g. on restarts) need the new code too
+            with jobs.stage(full_name, 'build'):
+                service.make_image()
+        else:
+            progress('Waiting to build the new image')
+            with jobs.stage(full_name, 'build'):
+                progress('Building new image')
+                service.make_image()
+            progress('Waiting to start new workers')
+            with jobs.stage(full_name, 'start'):
+                progress('Starting new workers')
+                service.start_workers(
+                    progress=lambda started, total: progress(
+                        'Starting new workers ({} of {} started)'
+                        .format(started, total)))
+                service.check_health()
+            progress('New workers ready', service=service)
+            swapped = True
+            response_cache.invalidate(full_name)
+            forget_adapter_cache(full_name)
+            progress('Draining old workers')
+            old_service.drain_workers(old_service.workers)
+            # values cached by the old workers while draining
+            forget_adapter_cache(full_name)
+        progress('Service ready', updating=False)
+
+        result = ok
+        data = service
+    except Exception as exc:
+        if not swapped and service.workers is not old_service.workers:
+            # the old service is still the one answering requests
+            service.stop_workers()
+        progress('Update error: {}'.format(exc), updating=False)
 
         result = error
         data = str(exc)
@@ -1494,11 +2574,35 @@ def to_bool(arg):
     else:
         return ''
 
-def validate_swagger_request(srv, endpoint, req):
-    sw = get_swagger(srv)
-    getter = JsonGetter(sw)
-    sw_app = pyswagger.SwaggerApp.load('', getter=getter)
+# Prepared swagger apps, by service: iden -> (registration, app)
+_swagger_apps = {}
+
+
+def swagger_app(srv):
+    """Return the prepared pyswagger app with the operations of ``srv``.
+
+    Preparing the app is expensive, so it's done once per registration
+    of the service (an update registers the service again) and cached
+    for the following requests.
+
+    """
+    registration = getattr(srv, 'registration_timestamp', None)
+    cached = _swagger_apps.get(srv.iden)
+    if cached is not None and cached[0] == registration:
+        return cached[1]
+    sw_app = pyswagger.SwaggerApp.load('',
+                                       getter=JsonGetter(get_swagger(srv)))
     sw_app.prepare(strict=True)
+    _swagger_apps[srv.iden] = (registration, sw_app)
+    return sw_app
+
+
+def forget_swagger_app(iden):
+    _swagger_apps.pop(iden, None)
+
+
+def validate_swagger_request(srv, endpoint, req):
+    sw_app = swagger_app(srv)
     operation = '{}_{}'.format(endpoint, req.method.lower())
     args = {k: v for (k, v) in req.args.to_dict(flat=False).items()
             if not k.startswith('_')}
@@ -243,6 +243,10 @@ class ServicesResource(restful.Resource):
                 'service',
                 namespace=service.namespace,
                 service=service.adapter_name),
+            'events_url': api_url_for(
+                'registration',
+                namespace=service.namespace,
+                service=service.adapter_name),
             'notification': service.notify
         }
         for endpoint in service.endpoint_names():
@@ -0,0 +1,150 @@
+"""Shared HTTP sessions for the requests to third party services.
+
+Each server process keeps one ``requests.Session`` per upstream host and
+TLS policy, so connections are kept alive and reused across requests
+instead of paying a new TCP (and TLS) handshake every time.  Since the
+sessions are shared by all the users, they never keep cookies.
+
+The pools can be tuned in the section ``[http]`` of the config file:
+
+- ``pool_maxsize``: connections kept alive per host,
+- ``pool_block``: whether to wait for a free connection instead of
+  opening more than ``pool_maxsize`` connections to a host,
+- ``retries``: number of retries on connection errors,
+- ``backoff``: seconds to wait before the first retry (doubling on each
+  new attempt).
+
+"""
+
+import cookielib
+import ssl
+import threading
+import time
+import urlparse
+
+import requests
+
+from .config import get_option
+
+
+POOL_MAXSIZE = get_option('http', 'pool_maxsize', 10)
+POOL_BLOCK = get_option('http', 'pool_block', False)
+RETRIES = get_option('http', 'retries', 2)
+BACKOFF = get_option('http', 'backoff', 0.1)
+
+# Methods that can be safely retried
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+class TLSv1Adapter(requests.adapters.HTTPAdapter):
+    """Adapter to support TLSv1 in requests."""
+
+    def init_poolmanager(self, connections, maxsize, block=False):
+        self.poolmanager = requests.packages.urllib3.poolmanager.PoolManager(
+            num_pools=connections,
+            maxsize=maxsize,
+            block=block,
+            ssl_version=ssl.PROTOCOL_TLSv1)
+
+
+class NoCookiesPolicy(cookielib.DefaultCookiePolicy):
+    """Policy rejecting all the cookies set by the upstreams."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+def make_session(tlsv1=False):
+    """Create a session with pools of kept-alive connections.
+
+    With ``tlsv1``, HTTPS connections use TLSv1 and certificates are not
+    verified.
+
+    :type tlsv1: bool
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    # the session is shared by all the users
+    session.cookies.set_policy(NoCookiesPolicy())
+    https_adapter = TLSv1Adapter if tlsv1 else requests.adapters.HTTPAdapter
+    # a session talks to a single host, so it needs a single pool
+    session.mount('https://', https_adapter(
+        pool_connections=1, pool_maxsize=POOL_MAXSIZE,
+        pool_block=POOL_BLOCK))
+    session.mount('http://', requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=POOL_MAXSIZE,
+        pool_block=POOL_BLOCK))
+    if tlsv1:
+        session.verify = False
+    return session
+
+
+def session_for(url, tlsv1=False):
+    """Return the shared session for the host of ``url``.
+
+    :type url: str
+    :type tlsv1: bool
+    :rtype: requests.Session
+    """
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.netloc, tlsv1)
+    with _lock:
+        try:
+            return _sessions[key]
+        except KeyError:
+            session = _sessions[key] = make_session(tlsv1)
+            return session
+
+
+def request(method, url, tlsv1=False, **kwargs):
+    """Send a request using the shared session for ``url``.
+
+    Connection errors are retried with exponential backoff, as long as
+    the method is idempotent and there is no streamed body that cannot
+    be sent again.
+
+    :type method: str
+    :type url: str
+    :type tlsv1: bool
+    :rtype: requests.Response
+    """
+    session = session_for(url, tlsv1)
+    replayable = (method.upper() in IDEMPOTENT and
+                  not hasattr(kwargs.get('data'), 'read'))
+    attempts = 1 + (RETRIES if replayable else 0)
+    for attempt in range(attempts):
+        try:
+            return session.request(method, url, **kwargs)
+        except requests.ConnectionError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(BACKOFF * 2 ** attempt)
+
+
+def stats():
+    """Usage of the connection pools of this process.
+
+    For each upstream, return the number of requests sent, the number
+    of connections opened, and how many requests reused a connection.
+
+    :rtype: dict[str, dict[str, int]]
+    """
+    result = {}
+    with _lock:
+        sessions = _sessions.items()
+    for (scheme, netloc, tlsv1), session in sessions:
+        pools = [adapter.poolmanager.pools[key]
+                 for adapter in set(session.adapters.values())
+                 for key in adapter.poolmanager.pools.keys()]
+        requests_sent = sum(pool.num_requests for pool in pools)
+        connections = sum(pool.num_connections for pool in pools)
+        name = '{}://{}{}'.format(scheme, netloc, ' (TLSv1)' if tlsv1 else '')
+        result[name] = {
+            'requests': requests_sent,
+            'connections': connections,
+            'reused': requests_sent - connections
+        }
+    return result
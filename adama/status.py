@@ -6,6 +6,7 @@ from . import __version__
 from .swagger import swagger
 from .api import ok
 from .tools import location_of
+from . import sessions
 
 
 @swagger.model
@@ -16,7 +17,10 @@ class StatusModel(object):
         'status': restful.fields.String(attribute='success or error'),
         'api': restful.fields.String(attribute='version of the API'),
         'hash': restful.fields.String(
-            attribute='commit hash of Adama server currently running')
+            attribute='commit hash of Adama server currently running'),
+        'http_pools': restful.fields.Raw(
+            attribute='reuse of connections to third party services '
+                      'in this server process')
     }
 
 
@@ -43,7 +47,8 @@ class StatusResource(restful.Resource):
 
         return ok({
             'api': 'Adama v{}'.format(__version__),
-            'hash': head_hash()
+            'hash': head_hash(),
+            'http_pools': sessions.stats()
         })
 
 
@@ -27,3 +27,22 @@ class Store(collections.MutableMapping):
 
     def __len__(self):
         return self._db.dbsize()
+
+    def delete_prefix(self, prefix):
+        """Remove all the keys starting with ``prefix``."""
+
+        keys = list(self._db.scan_iter(match=prefix + '*'))
+        if keys:
+            self._db.delete(*keys)
+
+    def setex(self, key, ttl, value):
+        """Set ``key`` to ``value`` for ``ttl`` seconds."""
+
+        self._db.setex(key, ttl, cPickle.dumps(value))
+
+    def setnx(self, key, value):
+        """Set ``key`` to ``value`` if it doesn't exist.
+
+        :rtype: bool
+        """
+        return bool(self._db.setnx(key, cPickle.dumps(value)))
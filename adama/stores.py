@@ -15,6 +15,9 @@ entity_store = config_store(db=5)
 prov_store = config_store(db=6)
 stats_store = config_store(db=7)
 debug_store = config_store(db=8)
+# entries of the adapters' cache (see ``Cache`` in adamalib)
+adapter_cache_store = config_store(db=9)
+worker_store = config_store(db=10)
 
 
 # Reserve gateway ip: 172.17.42.1
@@ -5,11 +5,13 @@ import json
 import sys
 from textwrap import dedent
 import time
+import uuid
 
 import logging
 logging.basicConfig()
 
 import pika
+import redis
 import zmq
 
 pika_logger = logging.getLogger('pika.adapters')
@@ -17,6 +19,19 @@ pika_logger.setLevel(logging.CRITICAL)
 
 ctx = zmq.Context()
 
+# Queue where the workers publish their heartbeats
+HEARTBEAT_QUEUE = 'adama_heartbeats'
+# Tag of the binary chunks, sent as messages of two frames
+CHUNK = 'CHUNK'
+# Redis database where producers flag the requests to cancel
+CANCEL_DB = 13
+# Seconds a cancellation flag is kept
+CANCEL_TTL = 300
+
+
+def cancel_key(message_id):
+    return 'cancel:{}'.format(message_id)
+
 
 class AbstractQueueConnection(object):
     """A task queue.
@@ -89,6 +104,14 @@ class QueueConnection(AbstractQueueConnection):
     def delete(self):
         self.channel.queue_delete(self.queue_name)
 
+    def close(self):
+        """Release the result socket and the connection to the queue."""
+
+        socket = getattr(self, 'socket', None)
+        if socket is not None and not socket.closed:
+            socket.close(linger=0)
+        self.connection.close()
+
     def connect(self):
         """Establish a connection with the task queue."""
 
@@ -128,6 +151,7 @@ class QueueConnection(AbstractQueueConnection):
         self.socket = ctx.socket(zmq.PULL)
         self.socket.bind('tcp://{}:*'.format(self.result_ip))
         self.data_port = self.socket.getsockopt(zmq.LAST_ENDPOINT)
+        self.message_id = uuid.uuid4().hex
 
         self.channel.basic_publish(exchange='',
                                    routing_key=self.queue_name,
@@ -135,7 +159,26 @@ class QueueConnection(AbstractQueueConnection):
                                    properties=pika.BasicProperties(
                                        # make message persistent
                                        delivery_mode=2,
-                                       reply_to=self.data_port))
+                                       reply_to=self.data_port,
+                                       message_id=self.message_id,
+                                       # to measure the time in the queue
+                                       headers={
+                                           'published': repr(time.time())
+                                       }))
+
+    def publish(self, message, ttl=None):
+        """Publish a message without waiting for any answer.
+
+        If ``ttl`` is given, the message is discarded after ``ttl``
+        seconds if nobody consumed it.
+
+        """
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=self.queue_name,
+            body=message,
+            properties=pika.BasicProperties(
+                expiration=str(int(ttl * 1000)) if ttl else None))
 
     def receive(self, max_wait=30):
         """Receive results from the queue.
@@ -187,12 +230,23 @@ class QueueConnection(AbstractQueueConnection):
 
     def on_consume(self, callback, ch, method, props, body):
 
+        try:
+            self.queue_wait = (
+                time.time() - float(props.headers['published']))
+        except (TypeError, KeyError, ValueError):
+            self.queue_wait = None
+
         socket = ctx.socket(zmq.PUSH)
         socket.connect(props.reply_to)
 
         def responder(result):
             socket.send(result)
 
+        def chunk_responder(chunk):
+            socket.send_multipart([CHUNK, chunk], copy=False)
+
+        responder.chunk = chunk_responder
+
         try:
             callback(body, responder)
         finally:
@@ -273,6 +327,47 @@ class Producer(QueueConnection):
                 return
             yield json.loads(message)
 
+    def receive_chunks(self, max_wait=30):
+        """Receive a header and then binary chunks until `END`.
+
+        Produce the header (a dictionary, empty if the worker didn't send
+        one), and then the chunks as strings.  Messages that are not
+        chunks (for example, errors) are produced as objects.
+
+        """
+        self.socket.setsockopt(zmq.RCVTIMEO, max_wait*1000)
+        try:
+            header = {}
+            frames = self.socket.recv_multipart()
+            while frames == ['HEADER']:
+                # the adapter may send its own header with provenance
+                header.update(json.loads(self.socket.recv()))
+                frames = self.socket.recv_multipart()
+            yield header
+            while frames != ['END']:
+                if frames[0] == CHUNK:
+                    yield frames[1]
+                else:
+                    yield json.loads(frames[0])
+                frames = self.socket.recv_multipart()
+            self.metadata = json.loads(self.socket.recv())
+            self.socket.close()
+        except zmq.error.Again:
+            raise TimeoutException(
+                'result channel {} has been idle for more than '
+                '{} seconds'.format(self.data_port, max_wait))
+
+    def cancel(self, store_host, store_port):
+        """Ask the worker to stop producing results for the last message.
+
+        The worker checks the flag periodically, so a few more results
+        may arrive after cancelling.
+
+        """
+        db = redis.StrictRedis(host=store_host, port=store_port,
+                               db=CANCEL_DB)
+        db.setex(cancel_key(self.message_id), CANCEL_TTL, 1)
+
 
 def check_queue(display=False):
     """Check that we can establish a connection to the queue."""
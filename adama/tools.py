@@ -17,6 +17,16 @@ def interleave(a, b):
         yield y
 
 
+def chunks(iterable, size):
+    """ [1,2,3,4,5], 2 -> [1,2], [3,4], [5] """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class TimeoutFunctionException(Exception):
     """Exception to raise on a timeout"""
     pass
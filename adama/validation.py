@@ -0,0 +1,192 @@
+"""Validation of the results of an adapter against its response schema.
+
+A service with ``validate_response`` checks each result of ``query``
+and ``map_filter`` adapters, as it is streamed, against the schema
+declared in the ``response`` of the endpoint.  The schema is compiled
+once into a tree of checking functions, which are cached per service
+registration.
+
+``validate_response`` is one of:
+
+- ``yes``: validate every result,
+- ``{first: N}``: validate only the first ``N`` results, or
+- ``{sample: R}``: validate the first result and a random fraction
+  ``R`` of the others.
+
+"""
+
+import json
+import numbers
+import random
+
+from .api import APIException
+
+
+class ResponseValidationError(APIException):
+    pass
+
+
+# Compiled validators: (iden, registration, endpoint) -> validator
+_validators = {}
+
+
+def validator_for(srv, endpoint):
+    """Return the compiled validator of the results of ``endpoint``.
+
+    Return None if the endpoint does not declare a response schema.
+
+    """
+    key = (srv.iden, getattr(srv, 'registration_timestamp', None), endpoint)
+    try:
+        return _validators[key]
+    except KeyError:
+        pass
+    schema = srv.response_schema(endpoint)
+    validator = compile_schema(schema) if schema else None
+    _validators[key] = validator
+    return validator
+
+
+def forget(iden):
+    for key in [key for key in _validators if key[0] == iden]:
+        _validators.pop(key, None)
+
+
+def sampler(spec):
+    """Return a function deciding whether to validate the n-th result.
+
+    ``spec`` is the value of ``validate_response`` (see module docs).
+
+    :rtype: (int) -> bool
+    """
+    if isinstance(spec, dict):
+        if 'first' in spec:
+            first = int(spec['first'])
+            return lambda n: n < first
+        if 'sample' in spec:
+            rate = float(spec['sample'])
+            return lambda n: n == 0 or random.random() < rate
+        raise APIException('validate_response must be yes, no, '
+                           '{first: N} or {sample: R}')
+    return lambda n: True
+
+
+def validate(results, validator, spec, endpoint, cancel=None):
+    """Check ``results`` (JSON strings) while passing them through.
+
+    On the first invalid result, call ``cancel`` (to stop the worker)
+    and raise ``ResponseValidationError``, which is reported at the end
+    of the stream as any other error.
+
+    """
+    check = sampler(spec)
+    for n, result in enumerate(results):
+        if check(n):
+            errors = validator(json.loads(result), 'result')
+            if errors:
+                if cancel is not None:
+                    cancel()
+                raise ResponseValidationError(
+                    'result {} of /{} does not match the response '
+                    'schema: {}'.format(n, endpoint, '; '.join(errors)))
+        yield result
+
+
+TYPES = {
+    'object': lambda x: isinstance(x, dict),
+    'array': lambda x: isinstance(x, list),
+    'string': lambda x: isinstance(x, basestring),
+    'integer': lambda x: (isinstance(x, (int, long)) and
+                          not isinstance(x, bool)),
+    'number': lambda x: (isinstance(x, numbers.Number) and
+                         not isinstance(x, bool)),
+    'boolean': lambda x: isinstance(x, bool),
+    'null': lambda x: x is None
+}
+
+
+def compile_schema(schema):
+    """Compile ``schema`` into a function returning a list of errors.
+
+    Supports the subset of Swagger schemas used to document adapters:
+    ``type``, ``enum``, ``properties``, ``required``,
+    ``additionalProperties`` and ``items``.  Other keywords are
+    ignored.
+
+    :type schema: dict
+    :rtype: (object, str) -> list[str]
+    """
+    checks = []
+    typ = schema.get('type')
+    if typ is None and 'properties' in schema:
+        typ = 'object'
+    if typ in TYPES:
+        checks.append(_check_type(typ))
+    if 'enum' in schema:
+        checks.append(_check_enum(schema['enum']))
+    if typ == 'object':
+        checks.append(_check_object(schema))
+    if typ == 'array' and isinstance(schema.get('items'), dict):
+        checks.append(_check_items(compile_schema(schema['items'])))
+
+    def validator(obj, path):
+        for check in checks:
+            errors = check(obj, path)
+            if errors:
+                return errors
+        return []
+
+    return validator
+
+
+def _check_type(typ):
+    is_type = TYPES[typ]
+
+    def check(obj, path):
+        if is_type(obj):
+            return []
+        return ['{} should be of type {}, not {}'.format(
+            path, typ, type(obj).__name__)]
+
+    return check
+
+
+def _check_enum(values):
+
+    def check(obj, path):
+        if obj in values:
+            return []
+        return ['{} should be one of {}'.format(path, values)]
+
+    return check
+
+
+def _check_object(schema):
+    properties = {name: compile_schema(sub)
+                  for name, sub in schema.get('properties', {}).items()}
+    required = schema.get('required', [])
+    closed = schema.get('additionalProperties') is False
+
+    def check(obj, path):
+        errors = ['{} is missing the property {!r}'.format(path, name)
+                  for name in required if name not in obj]
+        for name, value in obj.items():
+            sub_path = '{}.{}'.format(path, name)
+            if name in properties:
+                errors.extend(properties[name](value, sub_path))
+            elif closed:
+                errors.append('{} is not allowed'.format(sub_path))
+        return errors
+
+    return check
+
+
+def _check_items(validator):
+
+    def check(obj, path):
+        errors = []
+        for i, item in enumerate(obj):
+            errors.extend(validator(item, '{}[{}]'.format(path, i)))
+        return errors
+
+    return check
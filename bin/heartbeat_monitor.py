@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+from adama.command.worker_monitor import HeartbeatMonitor
+
+
+def main():
+    HeartbeatMonitor().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Throughput of the ingestion of upstream responses for map_filter.
+
+Serve a generated JSON (and NDJSON) document from a local HTTP stub and
+measure how fast ``adama.ingest.records`` produces its objects, for
+every ijson backend available.
+
+Run as::
+
+    python tests/bench_ingest.py [size in MB]
+
+"""
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import importlib
+import json
+import sys
+import threading
+import time
+
+import requests
+
+import adama.ingest
+
+
+RECORD = {'locus': 'AT1G01010', 'score': 12, 'name': 'NAC domain',
+          'tags': ['a', 'b', 'c'], 'nested': {'x': 1, 'y': 'z'}}
+
+
+def make_documents(size):
+    """Return a JSON and a NDJSON document of about ``size`` bytes."""
+
+    line = json.dumps(RECORD)
+    n = size // (len(line) + 1) + 1
+    as_json = '{"result": [' + ','.join([line] * n) + ']}'
+    as_ndjson = '\n'.join([line] * n) + '\n'
+    return as_json, as_ndjson, n
+
+
+def stub(documents):
+    """Start a HTTP server in a thread answering with ``documents``."""
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            content_type, body = documents[self.path]
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def measure(url, json_path, expected):
+    start = time.time()
+    response = requests.get(url, stream=True)
+    count = sum(1 for _ in adama.ingest.records(response, json_path))
+    elapsed = time.time() - start
+    assert count == expected, (count, expected)
+    return elapsed
+
+
+def main():
+    size = int(float(sys.argv[1]) * 2**20) if len(sys.argv) > 1 else 2**25
+    as_json, as_ndjson, n = make_documents(size)
+    url = stub({'/json': ('application/json', as_json),
+                '/ndjson': ('application/x-ndjson', as_ndjson)})
+    mb = len(as_json) / 2.0**20
+    print('{:.1f} MB, {} records'.format(mb, n))
+    for backend in ('yajl2_c', 'yajl2', 'python'):
+        try:
+            adama.ingest.ijson = importlib.import_module(
+                'ijson.backends.' + backend)
+        except (ImportError, OSError):
+            print('{:>8}: not available'.format(backend))
+            continue
+        elapsed = measure(url + '/json', 'result', n)
+        print('{:>8}: {:8.2f} MB/s'.format(backend, mb / elapsed))
+    elapsed = measure(url + '/ndjson', '', n)
+    print('{:>8}: {:8.2f} MB/s'.format(
+        'ndjson', len(as_ndjson) / 2.0**20 / elapsed))
+
+
+if __name__ == '__main__':
+    main()
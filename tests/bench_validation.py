@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Cost of validating a request against the parameters of an adapter.
+
+Validate the same request against the ``/search`` endpoint of the
+example in ``docs/full/parameters.rst``, preparing the swagger app for
+every request (as before caching it) and reusing the prepared app.
+
+Run as::
+
+    python tests/bench_validation.py [number of requests]
+
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from werkzeug.datastructures import MultiDict
+
+import adama.service
+
+
+ENDPOINTS = {
+    '/search': {
+        'parameters': [
+            {'name': 'x', 'type': 'string', 'required': True},
+            {'name': 'y', 'type': 'integer', 'format': 'int64',
+             'required': False, 'default': 5},
+            {'name': 'z', 'type': 'array', 'required': True,
+             'collectionFormat': 'multi',
+             'items': {'type': 'number', 'format': 'double'}},
+            {'name': 'w', 'type': 'string', 'required': True,
+             'enum': ['Spam', 'Eggs']}
+        ]
+    }
+}
+
+
+def measure(srv, req, n, cached):
+    start = time.time()
+    for _ in range(n):
+        if not cached:
+            adama.service.forget_swagger_app(srv.iden)
+        adama.service.validate_swagger_request(srv, 'search', req)
+    return (time.time() - start) / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    srv = adama.service.AbstractService(
+        name='bench', namespace='bench', type='query',
+        endpoints=ENDPOINTS, validate_request=True)
+    req = adama.service.BatchQuery(
+        'GET', MultiDict([('x', 'foo'), ('z', '1.5'), ('z', '2'),
+                          ('w', 'Spam')]))
+    print(adama.service.validate_swagger_request(srv, 'search', req))
+    cold = measure(srv, req, n, cached=False)
+    warm = measure(srv, req, n, cached=True)
+    print('{:>8}: {:8.3f} ms/request'.format('prepared', cold * 1000))
+    print('{:>8}: {:8.3f} ms/request'.format('cached', warm * 1000))
+    print('{:>8}: {:8.1f}x'.format('speedup', cold / warm))
+
+
+if __name__ == '__main__':
+    main()
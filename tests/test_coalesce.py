@@ -0,0 +1,120 @@
+import threading
+import time
+
+from flask import request, Response
+import pytest
+
+import adama
+from adama import coalesce, formats
+
+
+class FakeService(object):
+    coalesce = True
+    type = 'query'
+    timeout = 5
+
+    def __init__(self, iden):
+        self.iden = iden
+
+
+@pytest.fixture
+def no_wait(monkeypatch):
+    monkeypatch.setattr(coalesce, 'POLL_INTERVAL', 0)
+
+
+def run(service, execute):
+    with adama.app.test_request_context('/search?x=1'):
+        return coalesce.run(service, 'search',
+                            request._get_current_object(), execute)
+
+
+def fail():
+    raise AssertionError('followers must not execute')
+
+
+def followers(flight):
+    return int(coalesce._db.get(coalesce._followers(flight)) or 0)
+
+
+def test_leader_alone(no_wait):
+    service = FakeService('foox.alone_v0.1')
+    response = run(service, lambda: Response(iter(['spam', 'eggs'])))
+    assert ''.join(response.response) == 'spameggs'
+    assert not coalesce._db.keys('flight:foox.alone_v0.1:*')
+
+
+def test_follower_streams(no_wait):
+    service = FakeService('foox.follow_v0.1')
+    parts = ['spam', 'eggs', 'ham']
+    produced = threading.Event()
+    resume = threading.Event()
+
+    def body():
+        yield parts[0]
+        produced.set()
+        resume.wait(5)
+        for part in parts[1:]:
+            yield part
+
+    leader = run(service, lambda: Response(body(), status=201))
+    flight = coalesce._db.get(coalesce._db.keys('flight:*')[0])
+    chunks = iter(leader.response)
+    first = next(chunks)
+    followed = {}
+
+    def follow():
+        response = run(service, fail)
+        followed['response'] = response
+        followed['first'] = next(iter(response.response))
+        followed['rest'] = list(response.response)
+        followed['failed'] = formats.failed(response.response)
+
+    thread = threading.Thread(target=follow)
+    thread.start()
+    deadline = time.time() + 5
+    while not followers(flight) and time.time() < deadline:
+        time.sleep(0.01)
+    # the follower gets what was produced before it joined
+    resume.set()
+    assert first + ''.join(chunks) == 'spameggsham'
+    thread.join(5)
+    response = followed['response']
+    assert response.status_code == 201
+    assert response.headers['X-Adama-Coalesced'] == 'yes'
+    assert followed['first'] + ''.join(followed['rest']) == 'spameggsham'
+    assert not followed['failed']
+
+
+def test_follower_of_aborted_flight(no_wait):
+    service = FakeService('foox.abort_v0.1')
+    key, flight = 'flight:spam', 'eggs'
+    coalesce._db.set(key, flight)
+    leader = coalesce.Leader(key, flight, 5)
+    leader.start(200, [])
+    done = {}
+
+    def follow():
+        done['response'] = coalesce._follow(key, flight, 5, 'ndjson')
+
+    thread = threading.Thread(target=follow)
+    thread.start()
+    deadline = time.time() + 5
+    while not followers(flight) and time.time() < deadline:
+        time.sleep(0.01)
+    leader.add('{"a": 1}\n')
+    leader.finish(coalesce.ABORT)
+    thread.join(5)
+    stream = done['response'].response
+    body = ''.join(stream)
+    assert body.startswith('{"a": 1}\n')
+    assert '"_status": "error"' in body
+    assert formats.failed(stream)
+    assert coalesce._db.get(key) is None
+
+    # a flight ending before it had followers is not shared
+    coalesce._db.set(key, 'ham')
+    leader = coalesce.Leader(key, 'ham', 5)
+    leader.start(200, [])
+    leader.add('{"a": 1}\n')
+    leader.finish(coalesce.ABORT)
+    assert coalesce._follow(key, 'ham', 5, 'ndjson') is None
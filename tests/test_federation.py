@@ -0,0 +1,72 @@
+import json
+import time
+
+import pytest
+
+import adama
+from adama.api import APIException
+from adama.federation import FederationResource, federate
+
+
+def validate_post(body):
+    with adama.app.test_request_context(
+            '/federate', method='POST', data=json.dumps(body)):
+        return FederationResource().validate_post()
+
+def test_federate_unknown_endpoint():
+    for endpoint in ('os', 'map_filter', '__init__'):
+        with pytest.raises(APIException) as exc:
+            validate_post({'endpoint': endpoint,
+                           'targets': ['foo_ns/spam_v0.1']})
+        assert exc.value.code == 400
+
+class FakeService(object):
+
+    def __init__(self, results, error=None):
+        self._results = results
+        self.error = error
+        self.stopped = False
+
+    def results(self, endpoint, args, req):
+        if self.error is not None:
+            raise self.error
+
+        def stop():
+            self.stopped = True
+
+        return (iter(self._results), lambda: {'time_in_main': 1},
+                stop, 'prov-key')
+
+    def prov_url(self, key):
+        return 'prov/' + key
+
+def slow_results():
+    yield '{"a": 1}'
+    time.sleep(5)
+    yield '{"a": 2}'
+
+def test_federate():
+    slow = FakeService(slow_results())
+    targets = [
+        {'name': 'ns/ok', 'timeout': 5, 'prov': 'sources',
+         'service': FakeService(['{"a": 1}', '{"a": 2}'])},
+        {'name': 'ns/broken', 'timeout': 5, 'prov': 'sources',
+         'service': FakeService([], error=ValueError('boom'))},
+        {'name': 'ns/slow', 'timeout': 0.5, 'prov': 'sources',
+         'service': slow}]
+    lines = [json.loads(line)
+             for line in federate(targets, 'search', {}, None)]
+    by_source = {}
+    for line in lines[:-1]:
+        by_source.setdefault(line['source'], []).append(line)
+    assert [line['result'] for line in by_source['ns/ok'][:2]] == [
+        {'a': 1}, {'a': 2}]
+    assert by_source['ns/ok'][2]['status'] == 'success'
+    assert by_source['ns/ok'][2]['prov'] == 'prov/prov-key'
+    assert by_source['ns/broken'] == [{
+        'source': 'ns/broken', 'status': 'error', 'error': 'boom',
+        'prov': 'prov/sources'}]
+    assert by_source['ns/slow'][0]['result'] == {'a': 1}
+    assert by_source['ns/slow'][1]['status'] == 'timeout'
+    assert lines[-1]['_metadata']['targets'] == {
+        'ns/ok': 'success', 'ns/broken': 'error', 'ns/slow': 'timeout'}
@@ -280,6 +280,24 @@ def test_list():
     for i in range(3):
         assert result[i]['i'] == i
 
+def test_list_csv_pages():
+    url = URL+'/{}/{}_v1/list?foo=3&_format=csv&_limit=2'.format(
+        NAMESPACE, SERVICE)
+    response = requests.get(url)
+    assert response.headers['content-type'].startswith('text/csv')
+    lines = response.text.splitlines()
+    assert len(lines) == 4
+    trailer = json.loads(lines[-1][len('# '):])
+    assert trailer['_status'] == 'success'
+    cursor = trailer['_metadata']['next_cursor']
+    assert cursor
+
+    response = requests.get(url, params={'_cursor': cursor})
+    lines = response.text.splitlines()
+    assert len(lines) == 3
+    trailer = json.loads(lines[-1][len('# '):])
+    assert trailer['_metadata']['next_cursor'] is None
+
 def test_process():
     cwd = os.getcwd()
     os.chdir(HERE)
@@ -371,6 +389,14 @@ def test_git_branch_query():
     assert response['status'] == 'success'
     assert response['result'][0] == {'foo': 1}
 
+def test_federate_unknown_endpoint():
+    response = requests.post(
+        URL+'/federate',
+        data=json.dumps({'endpoint': 'os',
+                         'targets': ['{}/{}_v1'.format(NAMESPACE, SERVICE)]}))
+    assert response.status_code == 400
+    assert response.json()['status'] == 'error'
+
 def test_delete_service():
     for i in range(1, 14):
         resp = requests.delete(
@@ -0,0 +1,68 @@
+import time
+
+import pytest
+
+from adama import jobs
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    # run no jobs: just queue them
+    monkeypatch.setattr(jobs, 'dispatch', lambda: None)
+    keys = jobs._db.keys('jobs:*')
+    if keys:
+        jobs._db.delete(*keys)
+
+
+def test_namespaces_in_turn(queue):
+    for iden in ['a.1', 'a.2', 'a.3']:
+        jobs.submit('a', iden, len, 'spam')
+    jobs.submit('b', 'b.1', len, 'spam')
+    jobs.submit('c', 'c.1', len, 'spam')
+    order = []
+    job = jobs._next_job()
+    while job is not None:
+        iden, func, args = job
+        assert (func, args) == (len, ('spam',))
+        order.append(iden)
+        job = jobs._next_job()
+    assert order == ['a.1', 'b.1', 'c.1', 'a.2', 'a.3']
+    assert not jobs._db.scard(jobs.PENDING)
+
+
+def test_cancel(queue):
+    jobs.submit('a', 'a.1', len, 'spam')
+    jobs.submit('a', 'a.2', len, 'spam')
+    assert jobs.cancel('a', 'a.1')
+    assert jobs._next_job()[0] == 'a.2'
+    assert jobs._next_job() is None
+    # a running job is flagged instead
+    assert not jobs.cancel('a', 'a.2')
+    with pytest.raises(jobs.JobCancelled):
+        jobs.check_cancelled('a.2')
+
+
+def test_slot_of_crashed_runner(queue):
+    crashed = jobs.Semaphore('build', 1)
+    assert crashed.acquire(blocking=False)
+    # the process holding the slot dies without releasing it
+    jobs.Semaphore.held.discard(crashed)
+    other = jobs.Semaphore('build', 1)
+    assert not other.acquire(blocking=False)
+    assert 0 < jobs._db.ttl(crashed.key) <= jobs.SLOT_TTL
+    jobs._db.pexpire(crashed.key, 1)
+    time.sleep(0.01)
+    assert other.acquire(blocking=False)
+    other.release()
+    assert not jobs._db.keys('jobs:slot:*')
+
+
+def test_events_end(queue, monkeypatch):
+    monkeypatch.setattr(jobs, 'POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(jobs, 'EVENTS_TIMEOUT', 0.1)
+    stream = list(jobs.events('a.1', lambda: {'slot': 'busy'}))
+    assert len(stream) == 1
+    assert stream[0].startswith('retry: ')
+    assert 'event: busy\n' in stream[0]
+    stream = list(jobs.events('a.1', lambda: None))
+    assert stream[0].endswith('event: deleted\ndata: {}\n\n')
@@ -8,12 +8,24 @@ test_adama
 Tests for `adama` module.
 """
 
+import json
 import os
+import threading
 from textwrap import dedent
 
+import flask
 import pytest
+import requests
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
 
+import adama.firewall
+import adama.formats
+import adama.ingest
+import adama.response_cache
 import adama.service
+import adama.sessions
+import adama.validation
 from adama.tools import location_of
 from adama.docker import docker_output
 
@@ -132,3 +144,463 @@ def test_passthrough_service():
         url='http://httpbin.org')
     assert a.check_health()
     assert a.url == 'http://httpbin.org'
+
+def test_merge_metadata():
+    total = {}
+    adama.service.merge_metadata(total, {
+        'seq': 0,
+        'cache': {'hits': 1, 'misses': 2},
+        'telemetry': {'records': 10, 'rss_delta': 4096, 'http_time': None}})
+    adama.service.merge_metadata(total, {
+        'seq': 1,
+        'cache': None,
+        'telemetry': {'records': 5, 'rss_delta': 1024, 'http_time': 0.5}})
+    assert total['cache'] == {'hits': 1, 'misses': 2}
+    assert total['telemetry'] == {
+        'records': 15, 'rss_delta': 4096, 'http_time': 0.5}
+
+def test_page():
+    cancelled = []
+    args = {'_limit': '2', '_offset': '1', 'q': 'x'}
+    page = adama.service.Page(args)
+    assert args == {'q': 'x'}
+    assert page.needed == 4
+    assert list(page.paginate(iter(range(10)),
+                              lambda: cancelled.append(True))) == [1, 2]
+    assert cancelled == [True]
+    next_page = adama.service.Page({'_limit': '2',
+                                    '_cursor': page.to_json()['next_cursor']})
+    assert list(next_page.paginate(iter(range(4)), None)) == [3]
+    assert next_page.to_json() == {'next_cursor': None}
+
+def test_validate_response():
+    validator = adama.validation.compile_schema({
+        'type': 'object',
+        'required': ['locus'],
+        'properties': {
+            'locus': {'type': 'string'},
+            'score': {'type': 'integer'},
+            'tags': {'type': 'array', 'items': {'enum': ['a', 'b']}}
+        }
+    })
+    assert validator({'locus': 'AT1G01010', 'tags': ['a']}, 'r') == []
+    assert validator({'score': 1}, 'r') == ["r is missing the property 'locus'"]
+    assert validator({'locus': 'x', 'tags': ['c']}, 'r') == [
+        "r.tags[0] should be one of ['a', 'b']"]
+    results = ['{"locus": "x"}', '{"locus": 1}']
+    assert list(adama.validation.validate(
+        iter(results), validator, {'first': 1}, 'search')) == results
+    with pytest.raises(adama.validation.ResponseValidationError):
+        list(adama.validation.validate(iter(results), validator, True,
+                                       'search'))
+
+def test_sessions_reject_cookies():
+    session = adama.sessions.make_session()
+    cookie = requests.cookies.create_cookie('session', 'spam',
+                                            domain='example.com')
+    session.cookies.set_cookie_if_ok(cookie, None)
+    assert len(session.cookies) == 0
+
+class FakeUpstream(object):
+
+    def __init__(self, body, content_type='application/json'):
+        self.body = body
+        self.headers = {'Content-Type': content_type}
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def iter_lines(self, chunk_size=1):
+        return iter(self.body.splitlines())
+
+def test_file_like_wrapper():
+    wrapper = adama.ingest.FileLikeWrapper(FakeUpstream('abcdefg'),
+                                           chunk_size=4)
+    assert wrapper.read(3) == 'abc'
+    assert wrapper.read(3) == 'd'
+    assert wrapper.read(3) == 'efg'
+    assert wrapper.read(3) == ''
+
+def test_ingest_records():
+    upstream = FakeUpstream('{"data": {"rows": [{"a": 1}, {"a": 2}]}}')
+    assert list(adama.ingest.records(upstream, 'data.rows')) == [
+        {'a': 1}, {'a': 2}]
+    upstream = FakeUpstream('{"a": 1}\n\n{"a": 2}\n',
+                            'application/x-ndjson; charset=utf-8')
+    assert list(adama.ingest.records(upstream)) == [{'a': 1}, {'a': 2}]
+    upstream = FakeUpstream('{"a": 1}\n{"a": 2}\n')
+    assert list(adama.ingest.records(upstream, upstream_format='ndjson')) == [
+        {'a': 1}, {'a': 2}]
+
+def test_forget_adapter_cache():
+    from adama.service import forget_adapter_cache
+    from adama.stores import adapter_cache_store
+
+    db = adapter_cache_store._db
+    db.set('cache:foox.spam_v0.1:x', '1')
+    db.set('cache:foox.spam_v0.11:x', '1')
+    forget_adapter_cache('foox.spam_v0.1')
+    assert db.get('cache:foox.spam_v0.1:x') is None
+    assert db.get('cache:foox.spam_v0.11:x') == '1'
+
+def test_firewall_ruleset(monkeypatch):
+    monkeypatch.setattr(adama.firewall, '_rulesets', {})
+    monkeypatch.setattr(adama.firewall, 'get_nameservers',
+                        lambda: ['10.0.0.2'])
+    monkeypatch.setattr(adama.firewall, 'resolve_address',
+                        lambda addr: {'example.com': ['1.2.3.4']}.get(
+                            addr, [addr]))
+    rules = adama.firewall.ruleset(['example.com'])
+    lines = rules.splitlines()
+    assert lines[0] == '*filter'
+    assert '-A OUTPUT -d 1.2.3.4 -j ACCEPT' in lines
+    assert '-A OUTPUT -d 10.0.0.2 -j ACCEPT' in lines
+    assert lines[-2:] == ['-A OUTPUT -j DROP', 'COMMIT']
+    assert adama.firewall.ruleset(['example.com']) is rules
+
+def test_content_hash(tmpdir):
+    tmpdir.join('main.py').write('print 1\n')
+    tmpdir.mkdir('lib').join('helper.py').write('X = 1\n')
+    digest = adama.service.content_hash(str(tmpdir))
+    assert len(digest) == adama.service.IMAGE_HASH_LENGTH
+    assert adama.service.content_hash(str(tmpdir)) == digest
+    assert adama.service.content_hash(str(tmpdir), 'sha256:1') != digest
+    tmpdir.join('lib', 'helper.py').write('X = 2\n')
+    assert adama.service.content_hash(str(tmpdir)) != digest
+
+def test_store_prov():
+    prov = {'sources': [{'title': 'spam'}]}
+    key = adama.service.store_prov(prov)
+    assert adama.service.store_prov({'sources': [{'title': 'spam'}]}) == key
+    assert adama.service.prov_store[key] == prov
+    # a key evicted from the store is written again
+    del adama.service.prov_store[key]
+    assert adama.service.store_prov(prov) == key
+    assert adama.service.prov_store[key] == prov
+
+class FakeCache(object):
+
+    def __init__(self):
+        self.saved = {}
+
+    def pipeline(self):
+        return self
+
+    def hmset(self, key, mapping):
+        self.saved[key] = mapping
+        return self
+
+    def expire(self, key, ttl):
+        return self
+
+    def execute(self):
+        pass
+
+def test_response_cache_tee(monkeypatch):
+    cache = FakeCache()
+    monkeypatch.setattr(adama.response_cache, '_db', cache)
+
+    def tee(key, produce):
+        chunks = adama.formats.Stream(produce)
+        stream = adama.formats.Stream(
+            lambda stream: adama.response_cache._tee(
+                stream, chunks, key, 60, 200, [], 'etag-' + key))
+        return ''.join(stream), stream.failed
+
+    def ok(stream):
+        yield 'spam'
+        yield 'eggs'
+
+    def broken(stream):
+        yield 'spam'
+        stream.failed = True
+        yield '---\n'
+
+    assert tee('ok', ok) == ('spameggs', False)
+    assert ''.join(adama.response_cache.decompress(
+        cache.saved['ok']['body'])) == 'spameggs'
+    assert cache.saved['ok']['length'] == 8
+    assert cache.saved['ok']['etag'] == 'etag-ok'
+    assert tee('broken', broken) == ('spam---\n', True)
+    assert 'broken' not in cache.saved
+
+class FakeCachedService(object):
+    iden = 'foox.cached_v0.1'
+    cache_ttl = 60
+
+def test_response_cache_key():
+    service = FakeCachedService()
+
+    def key(**headers):
+        with adama.app.test_request_context('/search?x=1', headers=headers):
+            return adama.response_cache.cache_key(
+                service, 'search', flask.request._get_current_object())
+
+    assert key() == key()
+    assert key(Range='bytes=0-9') != key()
+    assert key(Range='bytes=0-9') != key(Range='bytes=10-19')
+    assert key(Range='bytes=0-9', **{'If-Range': 'x'}) != key(
+        Range='bytes=0-9')
+
+def test_response_cache_etag():
+    service = FakeCachedService()
+    with adama.app.test_request_context('/search?x=1'):
+        response = adama.response_cache.save(
+            service, 'search', flask.request._get_current_object(),
+            flask.Response(iter(['spam'])))
+    etag, weak = response.get_etag()
+    assert etag and not weak
+    assert response.headers['X-Adama-Cache'] == 'miss'
+
+def test_delimited():
+    results = ['{"a": 1, "b": "x"}', '{"a": [1, 2], "c": true}']
+    assert ''.join(adama.formats.delimited(iter(results), ',', None)) == (
+        'a,b\n1,x\n"[1, 2]",\n')
+    assert ''.join(adama.formats.delimited(iter(results), '\t',
+                                           ['c', 'a'])) == (
+        'c\ta\n\t1\ntrue\t[1, 2]\n')
+    assert list(adama.formats.delimited(iter([]), ',', None)) == []
+
+def test_negotiate():
+    def negotiate(query_string='', accept=None):
+        headers = {'Accept': accept} if accept else {}
+        return adama.formats.negotiate(Request(EnvironBuilder(
+            query_string=query_string, headers=headers).get_environ()))
+
+    assert negotiate() == 'json'
+    assert negotiate('_format=tsv') == 'tsv'
+    assert negotiate('_format=csv', 'application/x-msgpack') == 'csv'
+    assert negotiate(accept='application/x-ndjson') == 'ndjson'
+    assert negotiate(accept='text/html') == 'json'
+    with pytest.raises(adama.service.APIException):
+        negotiate('_format=xml')
+
+
+def test_encode_delimited():
+    def encode(results, fail=False):
+        def produce():
+            for result in results:
+                yield result
+            if fail:
+                raise ValueError('spam')
+
+        stream = adama.formats.Stream(lambda stream: adama.formats.encode(
+            'csv', produce(), lambda: {'next_cursor': 'abc'},
+            stream=stream))
+        return ''.join(stream).splitlines(), stream.failed
+
+    lines, failed = encode(['{"a": 1}', '{"a": 2}'])
+    assert lines[:3] == ['a', '1', '2']
+    assert lines[3].startswith(adama.formats.COMMENT)
+    trailer = json.loads(lines[3][len(adama.formats.COMMENT):])
+    assert trailer['_status'] == 'success'
+    assert trailer['_metadata']['next_cursor'] == 'abc'
+    assert not failed
+
+    lines, failed = encode(['{"a": 1}'], fail=True)
+    assert lines[:2] == ['a', '1']
+    assert len(lines) == 3
+    trailer = json.loads(lines[2][len(adama.formats.COMMENT):])
+    assert trailer['_status'] == 'error'
+    assert 'ValueError: spam' in trailer['_error']
+    assert failed
+
+class FakeLogs(object):
+    """Logs producing ``lines`` and then waiting until closed."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        for line in self.lines:
+            yield line
+        self.closed.wait()
+
+    def close(self):
+        self.closed.set()
+
+def test_watch_workers_reloaded():
+    logs = {'a': FakeLogs(['*** WORKER STARTED\n',
+                           '*** WORKER RELOADED\n']),
+            'b': FakeLogs(['*** WORKER STARTED\n'])}
+    states = adama.service.watch_workers(
+        ['a', 'b'], 0.5, logs=logs, ready=adama.service.WORKER_RELOADED)
+    assert states == {'a': adama.service.WorkerState.started, 'b': None}
+    logs = {'a': FakeLogs(['Traceback\n', '*** WORKER ERROR\n'])}
+    states = adama.service.watch_workers(
+        ['a'], 5, logs=logs, ready=adama.service.WORKER_RELOADED)
+    assert states == {'a': adama.service.WorkerState.error}
+
+def watch(lines, timeout):
+    logs = FakeLogs(lines)
+    before = threading.active_count()
+    states = adama.service.watch_workers(['a'], timeout, logs={'a': logs})
+    # the stream is closed and its thread finished
+    assert logs.closed.is_set()
+    assert threading.active_count() == before
+    return states['a']
+
+def test_watch_workers():
+    WorkerState = adama.service.WorkerState
+    assert watch(['spam\n', '*** WORKER STARTED\n'], 5) == WorkerState.started
+    assert watch(['Traceback\n', '*** WORKER ERROR\n'], 5) == WorkerState.error
+    assert watch(['spam\n'], 0.1) is None
+
+def test_worker_state(monkeypatch):
+    from adama.command import worker_monitor
+
+    running = set()
+    monkeypatch.setattr(worker_monitor, 'is_running',
+                        lambda cid: cid in running)
+    monkeypatch.setattr(worker_monitor, 'exec_status',
+                        lambda cid, *cmd: 1)
+    sender = 'aaaaaaaaaaaa0123'
+    legacy = 'bbbbbbbbbbbb0123'
+    running.update([sender, legacy])
+    worker_monitor.record_heartbeat({'worker': sender[:12], 'state': 'busy'})
+    assert worker_monitor.worker_state(sender)['state'] == 'busy'
+    assert worker_monitor.worker_state(legacy)['state'] == 'idle'
+    # a worker whose heartbeats stopped is down, even if still running
+    del worker_monitor.worker_store[sender[:12]]
+    assert not worker_monitor.is_up(sender)
+    running.remove(legacy)
+    assert not worker_monitor.is_up(legacy)
+
+class FakeProducer(object):
+    """Producer answering map_filter messages as a worker would."""
+
+    events = []
+
+    def __init__(self, **kwargs):
+        self.metadata = {}
+
+    def send(self, message):
+        self.events.append(('send', message.get('_seq')))
+        self.message = message
+
+    def receive(self, max_wait=30):
+        message = self.message
+        self.events.append(('receive', message.get('_seq')))
+        yield {}
+        records = message.get('_batch', [message])
+        for record in records:
+            yield {'x': record['x'] * 10}
+        self.metadata = {'telemetry': {'records': len(records)}}
+        if '_batch' in message:
+            self.metadata['seq'] = message['_seq']
+
+    def close(self):
+        pass
+
+def test_process_by_client(monkeypatch):
+    monkeypatch.setattr(adama.service, 'Producer', FakeProducer)
+    monkeypatch.setattr(adama.service, 'MAP_FILTER_BATCH_SIZE', 2)
+    service = adama.service.Service.__new__(adama.service.Service)
+    service.iden = 'foox.spam_v0.1'
+    service.workers = ['aaaaaaaaaaaa0123']
+    service.timeout = 30
+
+    def process(protocol):
+        monkeypatch.setattr(adama.service, 'last_heartbeat',
+                            lambda cid: {'protocol': protocol})
+        FakeProducer.events = []
+        metadata = {}
+        results = [json.loads(result)
+                   for result in adama.service.process_by_client(
+                       service, ({'x': i} for i in range(5)), {},
+                       metadata)]
+        assert results == [{'x': i * 10} for i in range(5)]
+        assert metadata['telemetry']['records'] == 5
+        return FakeProducer.events
+
+    # two batches in flight per worker, answered in order
+    assert process(2) == [
+        ('send', 0), ('send', 1), ('receive', 0),
+        ('send', 2), ('receive', 1), ('receive', 2)]
+    # older workers get a record per message
+    assert process(1) == [
+        ('send', None), ('send', None), ('receive', None),
+        ('send', None), ('receive', None),
+        ('send', None), ('receive', None),
+        ('send', None), ('receive', None), ('receive', None)]
+
+class FakeQueryProducer(FakeProducer):
+    """Producer answering queries as a QueryWorker would."""
+
+    def receive(self, max_wait=30):
+        query = self.message
+        self.events.append(('receive', query['x']))
+        yield {}
+        if query.get('fail'):
+            yield {'error': 'boom', 'traceback': 'Traceback'}
+        else:
+            yield {'y': query['x']}
+        self.metadata = {'time_in_main': 0.1}
+
+class FakeQueryService(object):
+    iden = 'foox.spam_v0.1'
+    workers = ['aaaaaaaaaaaa0123']
+    timeout = 30
+    sources = []
+
+    def prov_url(self, key):
+        return 'prov/' + key
+
+def test_batch_generator(monkeypatch):
+    monkeypatch.setattr(adama.service, 'Producer', FakeQueryProducer)
+    monkeypatch.setattr(adama.service, 'BATCH_QUERIES_PER_WORKER', 2)
+    monkeypatch.setattr(adama.service, 'store_prov', lambda header: 'key')
+
+    def message(service, query, req):
+        if 'x' not in query:
+            raise adama.service.APIException('missing x')
+        return query
+
+    monkeypatch.setattr(adama.service, 'batch_message', message)
+    FakeQueryProducer.events = []
+    queries = [{'x': 1}, {}, {'x': 2, 'fail': True}, {'x': 3}]
+    lines = [json.loads(line) for line in adama.service.batch_generator(
+        FakeQueryService(), queries, None)]
+    assert [(line['index'], line.get('status')) for line in lines] == [
+        (1, 'error'), (0, None), (0, 'success'), (2, 'error'),
+        (3, None), (3, 'success')]
+    assert lines[0]['error'] == 'missing x'
+    assert lines[1]['result'] == {'y': 1}
+    assert lines[2]['prov'] == 'prov/key'
+    assert lines[2]['metadata']['time_in_main'] == 0.1
+    assert lines[3]['error'] == 'boom'
+    # at most two queries in flight (the second one failed to be sent)
+    assert FakeQueryProducer.events == [
+        ('send', None), ('receive', 1),
+        ('send', None), ('send', None), ('receive', 2), ('receive', 3)]
+
+def test_page_metadata():
+    metadata = {}
+
+    def results(n):
+        for i in range(n):
+            yield i
+        # the metadata arrives after the last result
+        metadata['n'] = n
+
+    def paginate(n):
+        cancelled = []
+        gen = results(n)
+        page = adama.service.Page({'_limit': '2'})
+        records = list(page.paginate(gen, lambda: adama.service.drain(
+            gen, lambda: cancelled.append(True))))
+        assert records == [0, 1]
+        assert page.next_cursor is not None
+        return cancelled
+
+    # the worker stopped at the end of the page
+    assert paginate(3) == []
+    assert metadata == {'n': 3}
+    assert paginate(100) == [True]
+    assert metadata == {'n': 3}
+
+def test_without_reserved():
+    args = {'q': 'x', '_format': 'csv', '_limit': '2'}
+    assert adama.service.without_reserved(args) == {'q': 'x'}
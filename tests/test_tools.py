@@ -24,4 +24,9 @@ def test_function_wins(f):
 def test_timeout_wins(f):
     g = t.TimeoutFunction(f(0.2), 0.1)
     with pytest.raises(t.TimeoutFunctionException):
-        g()
\ No newline at end of file
+        g()
+
+def test_chunks():
+    assert list(t.chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(t.chunks(iter([1, 2]), 2)) == [[1, 2]]
+    assert list(t.chunks([], 3)) == []
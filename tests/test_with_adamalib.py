@@ -1,3 +1,4 @@
+import json
 import subprocess
 import time
 
@@ -218,3 +219,77 @@ def test_with_exception(with_exception):
     assert 'error' in result[1]
     empty_result = with_exception.search(empty=True)
     assert empty_result == []
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_lru_eviction():
+    lru = adamalib.LRU(size=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    with pytest.raises(KeyError):
+        lru.get('b')
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+
+
+def test_lru_ttl(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(adamalib, 'time', clock)
+    lru = adamalib.LRU()
+    lru.set('a', 1, ttl=10)
+    lru.set('b', 2)
+    clock.now += 5
+    assert lru.get('a') == 1
+    clock.now += 10
+    with pytest.raises(KeyError):
+        lru.get('a')
+    assert lru.get('b') == 2
+
+
+def test_cache_hits_and_misses():
+    cache = adamalib.Cache('foox.spam_v0.1', local=adamalib.LRU())
+    assert cache.get('x') is None
+    cache.set('x', {'a': [1]})
+    value = cache.get('x')
+    value['a'].append(2)
+    assert cache.get('x') == {'a': [1]}
+    assert cache.stats == {'hits': 2, 'misses': 1}
+
+
+def test_cache_store():
+    from adama.config import Config
+
+    def new_cache(service):
+        return adamalib.Cache(service, Config.get('store', 'host'),
+                              Config.getint('store', 'port'),
+                              local=adamalib.LRU())
+
+    cache = new_cache('foox.spam_v0.1')
+    cache.set('x', {'a': 1}, ttl=60)
+    assert json.loads(cache._db.get('cache:foox.spam_v0.1:x')) == {'a': 1}
+    # other workers of the service see it, other services don't
+    assert new_cache('foox.spam_v0.1').get('x') == {'a': 1}
+    assert new_cache('foox.eggs_v0.1').get('x') is None
+
+
+def test_memoize():
+    cache = adamalib.Cache('foox.spam_v0.1', local=adamalib.LRU())
+    calls = []
+
+    @cache.memoize(ttl=60)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert [square(2), square(2), square(3)] == [4, 4, 9]
+    assert calls == [2, 3]